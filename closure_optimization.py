@@ -6,8 +6,14 @@ import time
 import open3d as o3d
 import numpy as np
 import copy
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
 
 from utils import io
+from utils import cache
+from utils import tfm
+from utils import features
+from utils import metrics
 
 
 parser = argparse.ArgumentParser()
@@ -27,59 +33,666 @@ parser.add_argument(
     default=1,
     help="number of continuous (by folder names) point clouds to merge together",
 )
+parser.add_argument(
+    "--num_workers",
+    type=int,
+    default=1,
+    help="number of worker processes for loading point clouds and pairwise"
+    " registration. default is 1",
+)
+parser.add_argument(
+    "--cache_dir",
+    type=str,
+    default="",
+    help="cache directory of downsampled point clouds and pairwise registrations."
+    " default is none",
+)
+parser.add_argument(
+    "--cache_max_gb",
+    type=float,
+    default=10.0,
+    help="size budget of the cache in GB, least recently used entries are evicted."
+    " default is 10",
+)
+parser.add_argument(
+    "--candidate_distance",
+    type=float,
+    default=None,
+    help="only register non-adjacent point clouds closer than this distance (m)"
+    " as loop closure candidates. default is none, i.e. all pairs",
+)
+parser.add_argument(
+    "--candidate_mode",
+    type=str,
+    default="trajectory",
+    choices=["trajectory", "bbox"],
+    help="distance used for loop closure candidates: between trajectories or"
+    " between bounding boxes. default is trajectory",
+)
+parser.add_argument(
+    "--backend",
+    type=str,
+    default="legacy",
+    choices=["legacy", "tensor"],
+    help="open3d API of pairwise registration: legacy, or tensor (open3d.t) with"
+    " float32 storage on CPU. default is legacy",
+)
+parser.add_argument(
+    "--trajectory_init",
+    action="store_true",
+    help="start pairwise ICP from the relative transforms given by the overlapping"
+    " trajectories of the point clouds, with a tighter coarse correspondence"
+    " distance",
+)
+parser.add_argument(
+    "--icp_pyramid",
+    type=str,
+    default="",
+    help="comma separated voxel size multipliers of the coarse levels of pairwise"
+    " ICP, coarsest first, e.g. 16,4. default is none, i.e. coarse and fine ICP"
+    " at full resolution",
+)
+parser.add_argument(
+    "--icp_min_fitness",
+    type=float,
+    default=0.1,
+    help="with --icp_pyramid, loop closure candidates below this fitness at a"
+    " coarse level stop early with a low information edge. default is 0.1",
+)
+parser.add_argument(
+    "--icp_max_rmse_ratio",
+    type=float,
+    default=0.5,
+    help="with --icp_pyramid, loop closure candidates whose inlier RMSE exceeds"
+    " this ratio of the correspondence distance at a coarse level stop early."
+    " default is 0.5",
+)
+parser.add_argument(
+    "--edge_prune_threshold",
+    type=float,
+    default=0.1,
+    help="edge prune threshold of pose graph optimization. default is 0.1",
+)
+parser.add_argument(
+    "--preference_loop_closure",
+    type=float,
+    default=2.0,
+    help="preference of loop closure edges in pose graph optimization."
+    " default is 2",
+)
 parser.add_argument("--output_dir", type=str, help="output directory")
+parser.add_argument(
+    "--no_display", action="store_true", help="do not display the result"
+)
+parser.add_argument(
+    "--incremental",
+    action="store_true",
+    help="reuse the pose graph saved in state_dir by the previous run, only"
+    " load and register new or changed point clouds and write changed transforms",
+)
+parser.add_argument(
+    "--state_dir",
+    type=str,
+    default="",
+    help="directory of the pose graph and point cloud identities kept for"
+    " --incremental. default is output_dir",
+)
+parser.add_argument(
+    "--metrics_out",
+    type=str,
+    default="",
+    help="JSON lines file the records of every stage (wall and CPU time, points,"
+    " fitness, inlier RMSE, iterations, peak RSS) are appended to. default is none",
+)
 args = parser.parse_args()
+metrics.set_output(args.metrics_out)
+
 
+def pyramid_registration(
+    source,
+    target,
+    max_correspondence_distance_coarse,
+    max_correspondence_distance_fine,
+    pyramid,
+    min_fitness=0.0,
+    max_rmse_ratio=1.0,
+    init=None,
+):
+    """Coarse to fine point-to-plane ICP. the pair is registered on decimated
+    clouds first (kept in the feature stores), and moves to a finer level only
+    if fitness and inlier RMSE are good enough, otherwise it stops early with a
+    low information edge computed on the decimated clouds. correspondence
+    distances shrink geometrically from coarse to fine
+
+    Args:
+        source (features.PointCloudFeatures): source point cloud
+        target (features.PointCloudFeatures): target point cloud
+        max_correspondence_distance_coarse: correspondence distance of the
+            coarsest level
+        max_correspondence_distance_fine: correspondence distance of the full
+            resolution level
+        pyramid (list[float]): voxel sizes of the coarse levels, coarsest first
+        min_fitness (float, optional): minimum fitness to move to a finer level.
+            Defaults to 0.0.
+        max_rmse_ratio (float, optional): maximum inlier RMSE, relative to the
+            correspondence distance, to move to a finer level. Defaults to 1.0.
+        init (numpy.array, optional): initial transformation. Defaults to None,
+            i.e. identity.
 
-def pairwise_registration(source, target):
+    Returns:
+        transformation_icp: transformation matrix
+        information_icp: information matrix
+    """
+    distances = np.geomspace(
+        max_correspondence_distance_coarse,
+        max_correspondence_distance_fine,
+        len(pyramid) + 1,
+    )
+    transformation = np.identity(4) if init is None else init
+    for voxel_size, distance in zip(pyramid, distances):
+        source_level = source.level(voxel_size)
+        target_level = target.level(voxel_size)
+        transformation_level, icp = features.icp(
+            source_level, target_level, distance, transformation
+        )
+        if icp.fitness < min_fitness or icp.inlier_rmse > max_rmse_ratio * distance:
+            print(
+                f"Stop ICP at voxel size {voxel_size}: fitness {icp.fitness:.3f},"
+                f" inlier RMSE {icp.inlier_rmse:.3f}"
+            )
+            information_icp = features.information_matrix(
+                source_level,
+                target_level,
+                max_correspondence_distance_fine,
+                transformation_level,
+            )
+            return transformation_level, information_icp
+        transformation = transformation_level
+
+    transformation_icp, icp_fine = features.icp(
+        source.cloud,
+        target.cloud,
+        max_correspondence_distance_fine,
+        transformation,
+        max_iteration=50,
+    )
+    information_icp = features.information_matrix(
+        source.cloud,
+        target.cloud,
+        max_correspondence_distance_fine,
+        transformation_icp,
+        icp_fine,
+    )
+    return transformation_icp, information_icp
+
+
+def pairwise_registration(
+    source,
+    target,
+    max_correspondence_distance_coarse,
+    max_correspondence_distance_fine,
+    pyramid=None,
+    min_fitness=0.0,
+    max_rmse_ratio=1.0,
+    init=None,
+):
     """Pairwise registration
 
     Args:
-        source: source point cloud
-        target: target point cloud
+        source (features.PointCloudFeatures): source point cloud
+        target (features.PointCloudFeatures): target point cloud
+        max_correspondence_distance_coarse: correspondence distance of coarse ICP
+        max_correspondence_distance_fine: correspondence distance of fine ICP
+        pyramid (list[float], optional): voxel sizes of coarse levels, see
+            pyramid_registration. Defaults to None, i.e. coarse and fine ICP at
+            full resolution.
+        min_fitness (float, optional): see pyramid_registration. Defaults to 0.0.
+        max_rmse_ratio (float, optional): see pyramid_registration.
+            Defaults to 1.0.
+        init (numpy.array, optional): initial transformation, e.g. from
+            trajectory_initial_guesses. Defaults to None, i.e. identity.
 
     Returns:
         transformation_icp: transformation matrix
         information_icp: information matrix
     """
+    if pyramid:
+        print("Apply point-to-plane ICP pyramid")
+        return pyramid_registration(
+            source,
+            target,
+            max_correspondence_distance_coarse,
+            max_correspondence_distance_fine,
+            pyramid,
+            min_fitness,
+            max_rmse_ratio,
+            init,
+        )
+
     print("Apply point-to-plane ICP")
-    icp_coarse = o3d.pipelines.registration.registration_icp(
-        source,
-        target,
+    source_coarse, target_coarse = source.cloud, target.cloud
+    if isinstance(source, features.TensorPointCloudFeatures):
+        # the correspondence search of tensor ICP slows down with the ratio of
+        # the distance to the point spacing, so the coarse ICP runs on clouds
+        # decimated to a tenth of its distance
+        source_coarse = source.level(max_correspondence_distance_coarse / 10)
+        target_coarse = target.level(max_correspondence_distance_coarse / 10)
+    transformation_coarse, _ = features.icp(
+        source_coarse,
+        target_coarse,
         max_correspondence_distance_coarse,
-        np.identity(4),
-        o3d.pipelines.registration.TransformationEstimationPointToPlane(),
+        np.identity(4) if init is None else init,
     )
-    icp_fine = o3d.pipelines.registration.registration_icp(
-        source,
-        target,
+    transformation_icp, icp_fine = features.icp(
+        source.cloud,
+        target.cloud,
         max_correspondence_distance_fine,
-        icp_coarse.transformation,
-        o3d.pipelines.registration.TransformationEstimationPointToPlane(),
-        criteria=o3d.pipelines.registration.ICPConvergenceCriteria(
-            relative_fitness=0.000001, relative_rmse=0.000001, max_iteration=50
-        ),
-    )
-    transformation_icp = icp_fine.transformation
-    information_icp = (
-        o3d.pipelines.registration.get_information_matrix_from_point_clouds(
-            source, target, max_correspondence_distance_fine, icp_fine.transformation
-        )
+        transformation_coarse,
+        max_iteration=50,
+    )
+    information_icp = features.information_matrix(
+        source.cloud,
+        target.cloud,
+        max_correspondence_distance_fine,
+        transformation_icp,
+        icp_fine,
     )
     return transformation_icp, information_icp
 
 
+def group_bboxes(catalog, merge_cnt):
+    """Bounding box of each merged point cloud from the segment catalog (see
+    io.load_segment_catalog), without loading the point clouds
+
+    Args:
+        catalog: segment catalog
+        merge_cnt: merge count, see io.load_point_clouds
+
+    Returns:
+        list of (bbox_min, bbox_max), None for groups without points
+    """
+    bboxes = []
+    for cnt in range(0, len(catalog), merge_cnt):
+        group = [e for e in catalog[cnt : cnt + merge_cnt] if e["bbox_min"] is not None]
+        if len(group) == 0:
+            bboxes.append(None)
+            continue
+        bboxes.append(
+            (
+                np.min([e["bbox_min"] for e in group], axis=0),
+                np.max([e["bbox_max"] for e in group], axis=0),
+            )
+        )
+    return bboxes
+
+
+def bbox_distance(source, target):
+    """Distance between two axis aligned bounding boxes (min, max), 0 if they
+    intersect or if one of them is None, i.e. it can not be pruned"""
+    if source is None or target is None:
+        return 0.0
+    gap = np.maximum(
+        0,
+        np.maximum(source[0] - target[1], target[0] - source[1]),
+    )
+    return np.linalg.norm(gap)
+
+
+def trajectory_distance(source, target, max_points=500):
+    """Minimum distance between two trajectories, each subsampled to about
+    max_points points. 0 if one of them is empty, i.e. it can not be pruned"""
+    if len(source) == 0 or len(target) == 0:
+        return 0.0
+    source = source[:: max(1, len(source) // max_points)]
+    target = target[:: max(1, len(target) // max_points)]
+    return np.linalg.norm(source[:, None, :] - target[None, :, :], axis=2).min()
+
+
+def trajectory_odometry(positions_s, timestamps_s, positions_t, timestamps_t):
+    """Relative transformation from the source to the target point cloud, fitted
+    on the trajectory samples recorded at the same time in both, i.e. within a
+    sampling interval. without such samples, the closest ones in time give a
+    translation
+
+    Args:
+        positions_s: (N, 3) trajectory of the source point cloud
+        timestamps_s: (N,) sorted timestamps of the source trajectory
+        positions_t: (M, 3) trajectory of the target point cloud
+        timestamps_t: (M,) sorted timestamps of the target trajectory
+
+    Returns:
+        numpy.array: 4x4 transformation matrix, identity if a trajectory is empty
+    """
+    if len(timestamps_s) == 0 or len(timestamps_t) == 0:
+        return np.identity(4)
+
+    # nearest target sample in time of each source sample
+    right = np.searchsorted(timestamps_t, timestamps_s).clip(0, len(timestamps_t) - 1)
+    left = (right - 1).clip(0, len(timestamps_t) - 1)
+    nearest = np.where(
+        np.abs(timestamps_t[left] - timestamps_s)
+        <= np.abs(timestamps_t[right] - timestamps_s),
+        left,
+        right,
+    )
+    dt = np.abs(timestamps_t[nearest] - timestamps_s)
+
+    tolerance = np.median(np.diff(timestamps_t)) if len(timestamps_t) > 1 else 0
+    index_s = np.flatnonzero(dt <= tolerance)
+    if len(index_s) == 0:
+        # e.g. the target starts after the source ends
+        index_s = [np.argmin(dt)]
+    return tfm.rigid_transform(positions_s[index_s], positions_t[nearest[index_s]])
+
+
+def trajectory_initial_guesses(positions, timestamps, pairs):
+    """Initial transformation of each pair from the trajectories. consecutive
+    point clouds are related by trajectory_odometry, other pairs by chaining
+    these
+
+    Args:
+        positions: trajectory of each point cloud
+        timestamps: timestamps of each trajectory
+        pairs: list of (source_id, target_id)
+
+    Returns:
+        dict: (source_id, target_id) -> 4x4 transformation matrix
+    """
+    poses = [np.identity(4)]
+    for i in range(1, len(positions)):
+        odometry = trajectory_odometry(
+            positions[i - 1], timestamps[i - 1], positions[i], timestamps[i]
+        )
+        poses.append(np.dot(poses[-1], np.linalg.inv(odometry)))
+    return {
+        (source_id, target_id): np.dot(
+            np.linalg.inv(poses[target_id]), poses[source_id]
+        )
+        for source_id, target_id in pairs
+    }
+
+
+def select_candidate_pairs(
+    bboxes, positions, distance=None, mode="trajectory", first_new=0
+):
+    """Select the pairs of point clouds to register
+
+    Args:
+        bboxes: bounding box of each point cloud, see group_bboxes. only used in
+            "bbox" mode
+        positions: trajectory of each point cloud
+        distance (float, optional): maximum distance of loop closure candidates.
+            Defaults to None, i.e. all pairs.
+        mode (str, optional): "trajectory" or "bbox". Defaults to "trajectory".
+        first_new (int, optional): only select pairs with target_id >= first_new,
+            i.e. pairs involving new point clouds. Defaults to 0.
+
+    Returns:
+        list of (source_id, target_id), sorted. odometry pairs are always kept
+    """
+    pairs = []
+    skipped = 0
+    n_pcds = len(positions)
+    n_odometry = max(0, n_pcds - max(1, first_new))
+    for source_id in range(n_pcds):
+        for target_id in range(max(source_id + 1, first_new), n_pcds):
+            if target_id != source_id + 1 and distance is not None:
+                if mode == "bbox":
+                    d = bbox_distance(bboxes[source_id], bboxes[target_id])
+                else:
+                    d = trajectory_distance(positions[source_id], positions[target_id])
+                if d > distance:
+                    skipped += 1
+                    continue
+            pairs.append((source_id, target_id))
+    print(
+        f"Loop closure candidates: {len(pairs) - n_odometry} evaluated, "
+        f"{skipped} skipped, {n_odometry} odometry pairs"
+    )
+    return pairs
+
+
+_POOL_ARRAYS = ("points", "colors", "normals")
+
+_pool_pcds = None
+_pool_dir = None
+_pool_backend = None
+_pool_distances = None
+_pool_pyramid = None
+
+
+def _share_point_clouds(pcd_dir, stores):
+    """write the clouds of feature stores, with their normals, to pcd_dir as
+    .npy files read by the pool workers, see _pool_store"""
+    for pcd_id, store in stores.items():
+        for name, array in zip(_POOL_ARRAYS, io.cloud_to_arrays(store.cloud)):
+            np.save(osp.join(pcd_dir, f"{pcd_id}_{name}.npy"), array)
+
+
+def _init_pairwise_pool(pcd_dir, distances, pyramid, backend):
+    """Process pool initializer. point clouds are not sent to the workers, each
+    worker maps those of its pairs from pcd_dir on first use"""
+    global _pool_pcds, _pool_dir, _pool_backend, _pool_distances, _pool_pyramid
+    _pool_pcds = {}
+    _pool_dir = pcd_dir
+    _pool_backend = backend
+    _pool_distances = distances
+    _pool_pyramid = pyramid
+
+
+def _pool_store(pcd_id):
+    """feature store of a point cloud in a pool worker. the arrays are memory
+    mapped (copy on write) and come with normals, so nothing is estimated again"""
+    if pcd_id not in _pool_pcds:
+        arrays = [
+            np.load(osp.join(_pool_dir, f"{pcd_id}_{name}.npy"), mmap_mode="c")
+            for name in _POOL_ARRAYS
+        ]
+        _pool_pcds[pcd_id] = features.feature_store(_pool_backend)(
+            io.cloud_from_arrays(*arrays, backend=_pool_backend)
+        )
+    return _pool_pcds[pcd_id]
+
+
+def _pyramid_args(pair, pyramid):
+    """pyramid arguments of pairwise_registration. odometry pairs are always
+    registered at full resolution, they hold the pose graph together"""
+    if pyramid is None:
+        return ()
+    levels, min_fitness, max_rmse_ratio = pyramid
+    if pair[1] == pair[0] + 1:
+        return (levels,)
+    return (levels, min_fitness, max_rmse_ratio)
+
+
+def _register_pair(stores, pair, distances, pyramid, init):
+    """pairwise_registration of a pair of feature stores, with a stage record"""
+    started = metrics.start()
+    source_id, target_id = pair
+    result = pairwise_registration(
+        stores[source_id],
+        stores[target_id],
+        *distances,
+        *_pyramid_args(pair, pyramid),
+        init=init,
+    )
+    metrics.record(
+        "pairwise_registration", started, source_id=source_id, target_id=target_id
+    )
+    return result
+
+
+def _pairwise_registration_worker(pair, init):
+    """Process pool entry of pairwise_registration"""
+    stores = {pcd_id: _pool_store(pcd_id) for pcd_id in pair}
+    return _register_pair(stores, pair, _pool_distances, _pool_pyramid, init)
+
+
+def pairwise_registrations(
+    pcds,
+    pairs,
+    max_correspondence_distance_coarse,
+    max_correspondence_distance_fine,
+    num_workers=1,
+    pcd_keys=None,
+    cache_dir="",
+    cache_max_bytes=None,
+    pyramid=None,
+    inits=None,
+    backend="legacy",
+):
+    """Register all pairs, in a process pool if num_workers > 1. each point
+    cloud gets a feature store (see features.PointCloudFeatures) shared by all
+    its pairs. with a pool, normals are still estimated here and the clouds are
+    shared through memory mapped files, so a worker only holds the clouds of
+    the pairs it registers. if pcd_keys and cache_dir are given, results are
+    kept in an edge cache keyed on the identity of both point clouds and the
+    registration parameters
+
+    Args:
+        pcds: point clouds, only those of pairs to register are used
+        pairs: list of (source_id, target_id)
+        max_correspondence_distance_coarse: correspondence distance of coarse ICP
+        max_correspondence_distance_fine: correspondence distance of fine ICP
+        num_workers (int, optional): number of processes. Defaults to 1.
+        pcd_keys (list[str], optional): content identity of each point cloud,
+            including its downsampling. Defaults to None, i.e. no cache.
+        cache_dir (str, optional): cache directory. Defaults to "".
+        cache_max_bytes (int, optional): size budget of the cache. Defaults to None.
+        pyramid (tuple, optional): (voxel sizes, min fitness, max RMSE ratio) of
+            the ICP pyramid, see pyramid_registration. Defaults to None.
+        inits (dict, optional): (source_id, target_id) -> initial transformation,
+            see trajectory_initial_guesses. Defaults to None, i.e. identity.
+        backend (str, optional): "legacy" or "tensor" (open3d.t, float32).
+            Defaults to "legacy".
+
+    Returns:
+        dict: (source_id, target_id) -> (transformation_icp, information_icp)
+    """
+    distances = (max_correspondence_distance_coarse, max_correspondence_distance_fine)
+    if inits is None:
+        inits = {}
+
+    results = {}
+    edge_keys = {}
+    if pcd_keys is not None and cache_dir != "":
+        for source_id, target_id in pairs:
+            key_parts = [
+                "pairwise_registration",
+                pcd_keys[source_id],
+                pcd_keys[target_id],
+                distances,
+                *_pyramid_args((source_id, target_id), pyramid),
+            ]
+            if (source_id, target_id) in inits:
+                key_parts.append(inits[(source_id, target_id)])
+            if backend != "legacy":
+                key_parts.append(backend)
+            edge_keys[(source_id, target_id)] = cache.cache_key(*key_parts)
+            cached = cache.load_arrays(
+                cache_dir, "edges", edge_keys[(source_id, target_id)]
+            )
+            if cached is not None:
+                results[(source_id, target_id)] = (
+                    cached["transformation"],
+                    cached["information"],
+                )
+        print(f"Edge cache: {len(results)} of {len(pairs)} pairs cached")
+
+    missing = [pair for pair in pairs if pair not in results]
+    # only the point clouds of pairs to register need normals
+    missing_ids = sorted({pcd_id for pair in missing for pcd_id in pair})
+    # normals are estimated once, here
+    stores = {
+        pcd_id: features.feature_store(backend)(pcds[pcd_id]) for pcd_id in missing_ids
+    }
+    if num_workers <= 1 or len(missing) <= 1:
+        for pair in missing:
+            results[pair] = _register_pair(
+                stores, pair, distances, pyramid, inits.get(pair)
+            )
+    else:
+        if cache_dir != "":
+            os.makedirs(cache_dir, exist_ok=True)
+        with tempfile.TemporaryDirectory(
+            prefix="pairwise_", dir=cache_dir if cache_dir != "" else None
+        ) as pcd_dir:
+            # tensor clouds are written as float32
+            _share_point_clouds(pcd_dir, stores)
+            with ProcessPoolExecutor(
+                max_workers=num_workers,
+                initializer=_init_pairwise_pool,
+                initargs=(
+                    pcd_dir,
+                    distances,
+                    pyramid,
+                    backend,
+                ),
+            ) as executor:
+                # pairs are sorted by source, chunks of them share point clouds
+                results.update(
+                    zip(
+                        missing,
+                        executor.map(
+                            _pairwise_registration_worker,
+                            missing,
+                            [inits.get(pair) for pair in missing],
+                            chunksize=max(1, len(missing) // (num_workers * 4)),
+                        ),
+                    )
+                )
+
+    if edge_keys:
+        for pair in missing:
+            transformation_icp, information_icp = results[pair]
+            cache.save_arrays(
+                cache_dir,
+                "edges",
+                edge_keys[pair],
+                cache_max_bytes,
+                transformation=transformation_icp,
+                information=information_icp,
+            )
+
+    return results
+
+
 def full_registration(
     pcds,
     max_correspondence_distance_coarse,
     max_correspondence_distance_fine,
     only_circle=False,
     only_last=False,
+    pairs=None,
+    num_workers=1,
+    pcd_keys=None,
+    cache_dir="",
+    cache_max_bytes=None,
+    previous_pose_graph=None,
+    first_new=0,
+    pyramid=None,
+    inits=None,
+    backend="legacy",
 ):
-    """Do full registration"""
+    """Do full registration. pairs (see select_candidate_pairs) defaults to all.
+    pairwise registrations run in num_workers processes, on the given backend,
+    with an optional ICP pyramid and initial transformations, and are cached if
+    pcd_keys and cache_dir are given (see pairwise_registrations). then the pose
+    graph is built in the order of pairs.
+    if previous_pose_graph is given, its first first_new nodes and the edges
+    between them are kept, pairs should only involve the following nodes, and
+    the poses of new nodes start from the last kept pose"""
     pose_graph = o3d.pipelines.registration.PoseGraph()
     odometry = np.identity(4)
-    pose_graph.nodes.append(o3d.pipelines.registration.PoseGraphNode(odometry))
+    if previous_pose_graph is not None and first_new > 0:
+        for node in list(previous_pose_graph.nodes)[:first_new]:
+            pose_graph.nodes.append(o3d.pipelines.registration.PoseGraphNode(node.pose))
+        for edge in previous_pose_graph.edges:
+            if edge.source_node_id < first_new and edge.target_node_id < first_new:
+                pose_graph.edges.append(edge)
+        odometry = np.linalg.inv(pose_graph.nodes[first_new - 1].pose)
+    else:
+        pose_graph.nodes.append(o3d.pipelines.registration.PoseGraphNode(odometry))
     n_pcds = len(pcds)
     # if only_circle:
     #     for source_id in range(n_pcds):
@@ -133,98 +746,267 @@ def full_registration(
     #             )
     #         )
     # else:
-    for source_id in range(n_pcds):
-        for target_id in range(source_id + 1, n_pcds):
-            transformation_icp, information_icp = pairwise_registration(
-                pcds[source_id], pcds[target_id]
+    if pairs is None:
+        pairs = select_candidate_pairs([None] * len(pcds), [[] for _ in pcds])
+    results = pairwise_registrations(
+        pcds,
+        pairs,
+        max_correspondence_distance_coarse,
+        max_correspondence_distance_fine,
+        num_workers,
+        pcd_keys,
+        cache_dir,
+        cache_max_bytes,
+        pyramid,
+        inits,
+        backend,
+    )
+    for source_id, target_id in pairs:
+        transformation_icp, information_icp = results[(source_id, target_id)]
+        print("Build o3d.pipelines.registration.PoseGraph")
+        if target_id == source_id + 1:  # odometry case
+            odometry = np.dot(transformation_icp, odometry)
+            pose_graph.nodes.append(
+                o3d.pipelines.registration.PoseGraphNode(np.linalg.inv(odometry))
             )
-            print("Build o3d.pipelines.registration.PoseGraph")
-            if target_id == source_id + 1:  # odometry case
-                odometry = np.dot(transformation_icp, odometry)
-                pose_graph.nodes.append(
-                    o3d.pipelines.registration.PoseGraphNode(np.linalg.inv(odometry))
+            pose_graph.edges.append(
+                o3d.pipelines.registration.PoseGraphEdge(
+                    source_id,
+                    target_id,
+                    transformation_icp,
+                    information_icp,
+                    uncertain=False,
                 )
-                pose_graph.edges.append(
-                    o3d.pipelines.registration.PoseGraphEdge(
-                        source_id,
-                        target_id,
-                        transformation_icp,
-                        information_icp,
-                        uncertain=False,
-                    )
-                )
-            else:  # loop closure case
-                pose_graph.edges.append(
-                    o3d.pipelines.registration.PoseGraphEdge(
-                        source_id,
-                        target_id,
-                        transformation_icp,
-                        information_icp,
-                        uncertain=True,
-                    )
+            )
+        else:  # loop closure case
+            pose_graph.edges.append(
+                o3d.pipelines.registration.PoseGraphEdge(
+                    source_id,
+                    target_id,
+                    transformation_icp,
+                    information_icp,
+                    uncertain=True,
                 )
+            )
     return pose_graph
 
 
-voxel_size = 0.02
-pcds, pcds_down, _, _ = io.load_point_clouds(
-    args.pointcloud_base,
-    args.pointcloud_prefix,
-    args.merge_cnt,
-    overlap_discard_num=0,
-    voxel_size=voxel_size,
-)
+if __name__ == "__main__":
+    run_started = metrics.start()
+    voxel_size = 0.02
+    state_dir = args.state_dir if args.state_dir != "" else args.output_dir
+    bboxes = None
+    if args.candidate_mode == "bbox":
+        # what the segments cover, before loading them
+        catalog = io.load_segment_catalog(
+            args.pointcloud_base,
+            args.pointcloud_prefix,
+            osp.join(
+                args.cache_dir if args.cache_dir != "" else state_dir,
+                "segment_catalog.json",
+            ),
+        )
+        io.print_segment_catalog(catalog)
+        bboxes = group_bboxes(catalog, args.merge_cnt)
 
+    max_correspondence_distance_coarse = voxel_size * 150
+    if args.trajectory_init:
+        # the initial guess is off by the trajectory drift only
+        max_correspondence_distance_coarse = voxel_size * 30
+    max_correspondence_distance_fine = voxel_size * 15
+    pyramid = None
+    if args.icp_pyramid != "":
+        pyramid = [
+            [voxel_size * float(m) for m in args.icp_pyramid.split(",")],
+            args.icp_min_fitness,
+            args.icp_max_rmse_ratio,
+        ]
 
-print("Full registration ...")
+    # point cloud identities are only needed to reuse the previous pose graph
+    # or cached results, they hash every segment file
+    keep_state = args.incremental or args.cache_dir != ""
+    pcd_keys = None
+    state = None
+    if keep_state:
+        pcd_keys = [
+            cache.cache_key(group_key, voxel_size)
+            for group_key in io.merged_group_keys(
+                args.pointcloud_base,
+                args.pointcloud_prefix,
+                args.merge_cnt,
+                args.cache_dir if args.cache_dir != "" else state_dir,
+            )
+        ]
+        state = {
+            "pcd_keys": pcd_keys,
+            "params": [
+                max_correspondence_distance_coarse,
+                max_correspondence_distance_fine,
+                args.candidate_distance,
+                args.candidate_mode,
+                pyramid,
+                args.trajectory_init,
+                args.backend,
+            ],
+        }
 
-max_correspondence_distance_coarse = voxel_size * 150
-max_correspondence_distance_fine = voxel_size * 15
-with o3d.utility.VerbosityContextManager(o3d.utility.VerbosityLevel.Debug) as cm:
-    pose_graph = full_registration(
-        pcds_down,
-        max_correspondence_distance_coarse,
-        max_correspondence_distance_fine,
+    # incremental: keep the nodes before the first new or changed point cloud
+    previous_pose_graph = None
+    previous_poses = []
+    first_new = 0
+    pose_graph_file = osp.join(state_dir, "pose_graph.json")
+    state_file = osp.join(state_dir, "pose_graph_state.json")
+    if args.incremental and osp.exists(pose_graph_file) and osp.exists(state_file):
+        with open(state_file, encoding="utf-8") as f:
+            previous_state = json.load(f)
+        if previous_state["params"] == state["params"]:
+            previous_pose_graph = o3d.io.read_pose_graph(pose_graph_file)
+            previous_poses = [node.pose for node in previous_pose_graph.nodes]
+            while (
+                first_new < min(len(pcd_keys), len(previous_state["pcd_keys"]))
+                and pcd_keys[first_new] == previous_state["pcd_keys"][first_new]
+            ):
+                first_new += 1
+        print(f"Incremental registration from point cloud {first_new}")
+
+    groups = None
+    if first_new > 0:
+        # only the new point clouds and those paired with them are loaded
+        positions, _ = io.load_trajectories(
+            args.pointcloud_base, args.pointcloud_prefix, args.merge_cnt, 0
+        )
+        pairs = select_candidate_pairs(
+            bboxes, positions, args.candidate_distance, args.candidate_mode, first_new
+        )
+        groups = set(range(first_new, len(positions)))
+        groups.update(pcd_id for pair in pairs for pcd_id in pair)
+        print(f"Loading {len(groups)} of {len(positions)} point clouds")
+
+    pcds, pcds_down, positions, timestamps = io.load_point_clouds(
+        args.pointcloud_base,
+        args.pointcloud_prefix,
+        args.merge_cnt,
+        overlap_discard_num=0,
+        voxel_size=voxel_size,
+        num_workers=args.num_workers,
+        cache_dir=args.cache_dir,
+        cache_max_bytes=int(args.cache_max_gb * 1e9),
+        groups=groups,
     )
+    if groups is None:
+        pairs = select_candidate_pairs(
+            bboxes, positions, args.candidate_distance, args.candidate_mode
+        )
 
+    print("Full registration ...")
 
-print("Optimizing PoseGraph ...")
+    inits = None
+    if args.trajectory_init:
+        inits = trajectory_initial_guesses(positions, timestamps, pairs)
+    with o3d.utility.VerbosityContextManager(
+        o3d.utility.VerbosityLevel.Debug
+    ) as cm:
+        pose_graph = full_registration(
+            pcds_down,
+            max_correspondence_distance_coarse,
+            max_correspondence_distance_fine,
+            pairs=pairs,
+            num_workers=args.num_workers,
+            pcd_keys=pcd_keys,
+            cache_dir=args.cache_dir,
+            cache_max_bytes=int(args.cache_max_gb * 1e9),
+            previous_pose_graph=previous_pose_graph,
+            first_new=first_new,
+            pyramid=pyramid,
+            inits=inits,
+            backend=args.backend,
+        )
 
-option = o3d.pipelines.registration.GlobalOptimizationOption(
-    max_correspondence_distance=max_correspondence_distance_fine,
-    edge_prune_threshold=0.1,
-    reference_node=0,
-    preference_loop_closure=2,
-)
-gloabl_criteria = o3d.pipelines.registration.GlobalOptimizationConvergenceCriteria()
-gloabl_criteria.max_iteration = 200
-with o3d.utility.VerbosityContextManager(o3d.utility.VerbosityLevel.Debug) as cm:
-    o3d.pipelines.registration.global_optimization(
-        pose_graph,
-        o3d.pipelines.registration.GlobalOptimizationLevenbergMarquardt(),
-        gloabl_criteria,
-        option,
+    print("Optimizing PoseGraph ...")
+
+    option = o3d.pipelines.registration.GlobalOptimizationOption(
+        max_correspondence_distance=max_correspondence_distance_fine,
+        edge_prune_threshold=args.edge_prune_threshold,
+        reference_node=0,
+        preference_loop_closure=args.preference_loop_closure,
+    )
+    gloabl_criteria = (
+        o3d.pipelines.registration.GlobalOptimizationConvergenceCriteria()
+    )
+    gloabl_criteria.max_iteration = 200
+    started = metrics.start()
+    n_edges = len(pose_graph.edges)
+    with o3d.utility.VerbosityContextManager(
+        o3d.utility.VerbosityLevel.Debug
+    ) as cm:
+        o3d.pipelines.registration.global_optimization(
+            pose_graph,
+            o3d.pipelines.registration.GlobalOptimizationLevenbergMarquardt(),
+            gloabl_criteria,
+            option,
+        )
+    metrics.record(
+        "pose_graph_optimization",
+        started,
+        nodes=len(pose_graph.nodes),
+        edges=n_edges,
+        edges_kept=len(pose_graph.edges),
+        max_iteration=gloabl_criteria.max_iteration,
     )
 
+    print("Transform points and display")
 
-print("Transform points and display")
+    color_1 = [0.9450980392, 0.5764705882, 0.7098039216]
+    color_2 = [0.11, 0.72, 0.89]
 
-color_1 = [0.9450980392, 0.5764705882, 0.7098039216]
-color_2 = [0.11, 0.72, 0.89]
+    pcds_down_transformed = []
 
-pcds_down_transformed = []
+    started = metrics.start()
+    n_written = 0
+    for point_id in range(len(pcds_down)):
+        print(pose_graph.nodes[point_id].pose)
+        if pcds_down[point_id] is not None:
+            # not loaded by an incremental run
+            pcds_down_transformed.append(copy.deepcopy(pcds_down[point_id]))
+            pcds_down_transformed[-1].transform(pose_graph.nodes[point_id].pose)
 
-for point_id in range(len(pcds_down)):
-    print(pose_graph.nodes[point_id].pose)
-    pcds_down_transformed.append(copy.deepcopy(pcds_down[point_id]))
-    pcds_down_transformed[point_id].transform(pose_graph.nodes[point_id].pose)
+            pcds_down_transformed[-1].paint_uniform_color(color_1)
+            pcds_down[point_id].paint_uniform_color(color_2)
 
-    pcds_down_transformed[point_id].paint_uniform_color(color_1)
-    pcds_down[point_id].paint_uniform_color(color_2)
+        transform_file = osp.join(args.output_dir, f"transform_{point_id:02d}.npy")
+        if (
+            point_id < len(previous_poses)
+            and osp.exists(transform_file)
+            and np.allclose(
+                previous_poses[point_id], pose_graph.nodes[point_id].pose, atol=1e-9
+            )
+        ):
+            # unchanged, keep the previous transform file
+            continue
+        np.save(transform_file, pose_graph.nodes[point_id].pose)
+        n_written += 1
 
-    np.save(
-        osp.join(args.output_dir, f"transform_{point_id:02d}.npy"),
-        pose_graph.nodes[point_id].pose,
+    if keep_state:
+        os.makedirs(state_dir, exist_ok=True)
+        o3d.io.write_pose_graph(pose_graph_file, pose_graph)
+        with open(state_file, "w", encoding="utf-8") as f:
+            json.dump(state, f)
+    pcds_loaded = [pcd for pcd in pcds_down if pcd is not None]
+    metrics.record(
+        "transform_save",
+        started,
+        points=sum(len(pcd.points) for pcd in pcds_loaded),
+        transforms_written=n_written,
+    )
+    metrics.record(
+        "run",
+        run_started,
+        script="closure_optimization",
+        args=vars(args),
+        point_clouds=len(pcds_down),
+        point_clouds_loaded=len(pcds_loaded),
+        pairs=len(pairs),
     )
 
-o3d.visualization.draw_geometries(pcds_down + pcds_down_transformed)
+    if not args.no_display:
+        o3d.visualization.draw_geometries(pcds_loaded + pcds_down_transformed)
@@ -26,7 +26,7 @@ args = parser.parse_args()
 
 
 if __name__ == "__main__":
-    positions, timestamps = io.load_coordinates_and_timestamps(args.trajectory)
+    positions, timestamps = io.load_trajectory(args.trajectory)
     wifi = pd.read_csv(args.wifi)
 
     # filter only AirPennNet
@@ -40,8 +40,7 @@ if __name__ == "__main__":
     wifi = wifi.pivot(index="write_time", columns="BSSID", values="level").reset_index()
 
     # process trajectory
-    timestamps = np.rint(np.asarray(timestamps) / 1e9)
-    positions = np.asarray(positions)
+    timestamps = np.rint(timestamps / 1e9)
     # concate timestamps and positions
     pos_data = np.concatenate((timestamps.reshape(-1, 1), positions), axis=1)
     # group by first column (timestamp)
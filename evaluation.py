@@ -48,9 +48,8 @@ wifi = wifi.groupby(["BSSID", "write_time"]).mean().reset_index()
 
 
 # ground truth
-positions, timestamps = io.load_coordinates_and_timestamps(args.trajectory)
-timestamps = np.rint(np.asarray(timestamps) / 1e9)
-positions = np.asarray(positions)
+positions, timestamps = io.load_trajectory(args.trajectory)
+timestamps = np.rint(timestamps / 1e9)
 # concate timestamps and positions
 pos_data = np.concatenate((timestamps.reshape(-1, 1), positions), axis=1)
 # group by first column (timestamp)
@@ -1,8 +1,10 @@
 from utils import io
 from utils import tfm
+from utils import tiles
 import open3d as o3d
 import matplotlib.pyplot as plt
 import argparse
+import os.path as osp
 
 
 parser = argparse.ArgumentParser()
@@ -24,15 +26,123 @@ parser.add_argument(
     default=10,
     help="scale of the floor plan",
 )
+parser.add_argument(
+    "--min_count",
+    type=int,
+    default=1,
+    help="minimum number of points of an occupied pixel. default is 1",
+)
+parser.add_argument(
+    "--min_neighbors",
+    type=int,
+    default=0,
+    help="occupied pixels with fewer occupied neighbors (out of 8) are removed as"
+    " noise. default is 0, i.e. none",
+)
+parser.add_argument(
+    "--density",
+    action="store_true",
+    help="save the point density of occupied pixels instead of black and white",
+)
+parser.add_argument(
+    "--tiles_dir",
+    type=str,
+    default="",
+    help="write a zoom pyramid of tiles and metadata.json to this directory instead"
+    " of a single image. default is none",
+)
+parser.add_argument(
+    "--tile_size",
+    type=int,
+    default=256,
+    help="tile size in pixels. default is 256",
+)
+parser.add_argument(
+    "--num_workers",
+    type=int,
+    default=1,
+    help="number of processes writing tiles. default is 1",
+)
+parser.add_argument(
+    "--floors",
+    action="store_true",
+    help="detect floor levels from the height histogram and write one floor plan"
+    " per floor, e.g. floorplan_floor0.png or TILES_DIR/floor0",
+)
+parser.add_argument(
+    "--floor_edges",
+    type=str,
+    default="",
+    help="comma separated height (y) edges of the floors, instead of detecting"
+    " them with --floors. default is none",
+)
+parser.add_argument(
+    "--floor_min_height",
+    type=float,
+    default=2.0,
+    help="minimum height of a floor detected with --floors. default is 2.0",
+)
 args = parser.parse_args()
 
-cloud = o3d.io.read_point_cloud(args.pointcloud)
 
-floorplan, min_coords, max_coords = tfm.retrieve_floor_plan(cloud, scale=args.scale)
+def save_floor_plan(floorplan, min_coords, max_coords, output, tiles_dir):
+    """write a floor plan as a single image, or as tiles if tiles_dir is given"""
+    if tiles_dir != "":
+        metadata = tiles.write_floor_plan_tiles(
+            tiles_dir,
+            floorplan,
+            min_coords,
+            max_coords,
+            args.scale,
+            tile_size=args.tile_size,
+            num_workers=args.num_workers,
+        )
+        n_tiles = sum(len(zoom["tiles"]) for zoom in metadata["zooms"].values())
+        print(f"{n_tiles} tiles in {metadata['max_zoom'] + 1} zoom levels")
+    else:
+        plt.imsave(output, floorplan, cmap="gray")
+    print(f"floor plan saved to: {tiles_dir or output}")
+
+
+if __name__ == "__main__":
+    points = io.read_ply_points(args.pointcloud)
+
+    height_edges = None
+    if args.floors and args.floor_edges == "":
+        # floors are detected in the binning pass of the floor plans
+        floorplan, min_coords, max_coords, height_edges = tfm.floor_density_raster(
+            points, scale=args.scale, min_separation=args.floor_min_height
+        )
+        floorplan = tfm.clean_floor_plan(
+            floorplan, args.min_count, args.min_neighbors, args.density
+        )
+    else:
+        if args.floor_edges != "":
+            height_edges = sorted(float(e) for e in args.floor_edges.split(","))
+        floorplan, min_coords, max_coords = tfm.retrieve_floor_plan(
+            points,
+            scale=args.scale,
+            min_count=args.min_count,
+            min_neighbors=args.min_neighbors,
+            density=args.density,
+            height_edges=height_edges,
+        )
+    if height_edges is not None:
+        print("floor height edges: " + ", ".join(f"{e:.2f}" for e in height_edges))
 
-plt.imsave(args.output, floorplan, cmap="gray")
+    print(f"minX: {min_coords[0]}, minY: {min_coords[1]}")
+    print(f"maxX: {max_coords[0]}, maxY: {max_coords[1]}")
+    print(f"scale: {args.scale}")
 
-print(f"minX: {min_coords[0]}, minY: {min_coords[1]}")
-print(f"maxX: {max_coords[0]}, maxY: {max_coords[1]}")
-print(f"scale: {args.scale}")
-print(f"floor plan saved to: {args.output}")
+    if height_edges is None:
+        save_floor_plan(floorplan, min_coords, max_coords, args.output, args.tiles_dir)
+    else:
+        stem, ext = osp.splitext(args.output)
+        for floor, floor_plan in enumerate(floorplan):
+            save_floor_plan(
+                floor_plan,
+                min_coords,
+                max_coords,
+                f"{stem}_floor{floor}{ext}",
+                osp.join(args.tiles_dir, f"floor{floor}") if args.tiles_dir else "",
+            )
@@ -29,6 +29,12 @@ parser.add_argument(
     default=1,
     help="number of continuous (by folder names) point clouds to merge together",
 )
+parser.add_argument(
+    "--num_workers",
+    type=int,
+    default=1,
+    help="number of worker processes for loading point clouds. default is 1",
+)
 parser.add_argument(
     "--transformation_dir",
     type=str,
@@ -48,11 +54,39 @@ parser.add_argument(
     "--trajectory_out",
     type=str,
     default="out.jsonl",
-    help="output trajectory file name",
+    help="output trajectory file name (.jsonl, or .traj for binary)",
+)
+parser.add_argument(
+    "--streaming",
+    action="store_true",
+    help="write each transformed point cloud to the output right after loading it,"
+    " so that merging runs in constant memory. nothing is displayed",
 )
 args = parser.parse_args()
 
 
+def main_streaming():
+    """Main function of streaming mode"""
+    matrices = io.load_transformation_matrices(args.transformation_dir)
+
+    # merge, transform and save point clouds
+    position_arr, timestamp_arr = io.merge_point_clouds_streaming(
+        args.pointcloud_base,
+        args.pointcloud_prefix,
+        args.merge_cnt,
+        args.overlap_discard_num,
+        matrices,
+        args.pointcloud_out,
+    )
+
+    # save trajectory
+    io.save_coodinates_and_timestamps(
+        args.trajectory_out,
+        np.concatenate(position_arr, axis=0),
+        np.concatenate(timestamp_arr, axis=0),
+    )
+
+
 def main():
     """Main function"""
 
@@ -69,22 +103,25 @@ def main():
         args.pointcloud_prefix,
         args.merge_cnt,
         args.overlap_discard_num,
+        num_workers=args.num_workers,
     )
 
     # transform clouds
     matrices = io.load_transformation_matrices(args.transformation_dir)
-    tfm.transform_clouds_and_trajectories(clouds, position_arr, matrices)
+    n_transformed = min(len(matrices), len(clouds))
+    for i in range(n_transformed):
+        clouds[i].transform(matrices[i])
 
     # trajectory
-    # points
-    points = []
-    for positions in position_arr:
-        points.extend(positions)
+    # points, all trajectories transformed in one array
+    points = np.concatenate(position_arr, axis=0).astype(np.float64, copy=False)
+    offsets = np.cumsum([0] + [len(positions) for positions in position_arr])
+    tfm.apply_transformations(
+        points, offsets[: n_transformed + 1], matrices[:n_transformed]
+    )
     trajectory = o3dobj.get_o3d_trajectory_object(points, color=[1, 0, 0])
     # timestamps
-    timestamps = []
-    for ts in timestamp_arr:
-        timestamps.extend(ts)
+    timestamps = np.concatenate(timestamp_arr, axis=0)
 
     # merge point clouds
     cloud_out = copy.deepcopy(clouds[0])
@@ -108,4 +145,7 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    if args.streaming:
+        main_streaming()
+    else:
+        main()
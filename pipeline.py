@@ -0,0 +1,366 @@
+import json
+import argparse
+import os
+import os.path as osp
+import shutil
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from utils import cache
+
+
+parser = argparse.ArgumentParser()
+parser.add_argument(
+    "--config",
+    type=str,
+    default="pipeline.json",
+    help="pipeline config file path",
+)
+parser.add_argument(
+    "--num_workers",
+    type=int,
+    default=1,
+    help="number of stages to run in parallel. default is 1",
+)
+parser.add_argument(
+    "--dry_run",
+    action="store_true",
+    help="only print the stages that would run",
+)
+args = parser.parse_args()
+
+script_dir = osp.dirname(osp.abspath(__file__))
+
+
+def stage(name, script, script_args, inputs, outputs):
+    """Declare a stage
+
+    Args:
+        name (str): stage name, i.e. {session}/{step}
+        script (str): python script under the repository root
+        script_args (list[str]): command line arguments of the script
+        inputs (list[str]): files or directories read by the stage
+        outputs (list[str]): files or directories written by the stage
+
+    Returns:
+        dict: stage
+    """
+    script = osp.join(script_dir, script)
+    # code of the stage is an input as well
+    code = [script] + [
+        osp.join(script_dir, "utils", f)
+        for f in sorted(os.listdir(osp.join(script_dir, "utils")))
+        if f.endswith(".py")
+    ]
+    return {
+        "name": name,
+        "cmd": [sys.executable, script] + [str(arg) for arg in script_args],
+        "inputs": inputs + code,
+        "outputs": outputs,
+    }
+
+
+def build_stages(config):
+    """Build the stages of the reproduce chain of every session
+
+    Args:
+        config (dict): pipeline config, see README
+
+    Returns:
+        list[dict]: stages
+    """
+    processed = config["processed"]
+    stages = []
+
+    for name, session in config["sessions"].items():
+        out = osp.join(processed, name)
+        segments = osp.join(session["raw"], "Segments")
+        transform_dir = osp.join(out, "transform")
+        # not an output, outputs are wiped before their stage runs, and the pose
+        # graph of --incremental has to survive until the next run
+        closure_state = osp.join(out, "closure_state")
+        pc = osp.join(out, "pc.ply")
+        trajectory = osp.join(out, "trajectory.jsonl")
+
+        stages.append(
+            stage(
+                f"{name}/closure",
+                "closure_optimization.py",
+                [
+                    "--pointcloud_base",
+                    segments,
+                    "--pointcloud_prefix",
+                    session["pointcloud_prefix"],
+                    "--merge_cnt",
+                    session["merge_cnt"],
+                    "--output_dir",
+                    transform_dir,
+                    "--state_dir",
+                    closure_state,
+                    "--no_display",
+                ]
+                + session.get("closure_args", []),
+                [segments],
+                [transform_dir],
+            )
+        )
+
+        stages.append(
+            stage(
+                f"{name}/merge",
+                "multi_merger_viewer.py",
+                [
+                    "--pointcloud_base",
+                    segments,
+                    "--pointcloud_prefix",
+                    session["pointcloud_prefix"],
+                    "--merge_cnt",
+                    session["merge_cnt"],
+                    "--transformation_dir",
+                    transform_dir,
+                    "--overlap_discard_num",
+                    session.get("overlap_discard_num", 0),
+                    "--pointcloud_out",
+                    pc,
+                    "--trajectory_out",
+                    trajectory,
+                    "--streaming",
+                ]
+                + session.get("merge_args", []),
+                [segments, transform_dir],
+                [pc, trajectory],
+            )
+        )
+
+        if "wifi" in session:
+            dataset = osp.join(out, "dataset.csv")
+            stages.append(
+                stage(
+                    f"{name}/dataset",
+                    "dataset_construction.py",
+                    ["--trajectory", trajectory, "--wifi", session["wifi"]]
+                    + ["--output", dataset],
+                    [trajectory, session["wifi"]],
+                    [dataset],
+                )
+            )
+
+        if "reference" in session:
+            ref = session["reference"]
+            ref_out = osp.join(processed, ref)
+            aligned = osp.join(out, f"trajectory_alignedto_{ref}.jsonl")
+            fgr = osp.join(out, f"registration_fgr_to_{ref}.npy")
+            icp = osp.join(out, f"registration_icp_to_{ref}.npy")
+            ref_pc = osp.join(ref_out, "pc.ply")
+            ref_trajectory = osp.join(ref_out, "trajectory.jsonl")
+            registration_args = session.get("registration_args", [])
+            outputs = [aligned, fgr]
+            if "--skip_icp" not in registration_args:
+                outputs.append(icp)
+
+            stages.append(
+                stage(
+                    f"{name}/registration",
+                    "registration.py",
+                    [
+                        "--pointcloud1",
+                        pc,
+                        "--trajectory1",
+                        trajectory,
+                        "--pointcloud2",
+                        ref_pc,
+                        "--trajectory2",
+                        ref_trajectory,
+                        "--fast_cache",
+                        fgr,
+                        "--icp_cache",
+                        icp,
+                        "--transformed_trajectory_out",
+                        aligned,
+                        "--no_display",
+                    ]
+                    + registration_args,
+                    [pc, trajectory, ref_pc, ref_trajectory],
+                    outputs,
+                )
+            )
+
+            if "wifi" in session:
+                ref_dataset = osp.join(ref_out, "dataset.csv")
+                errors = osp.join(out, f"errors_to_{ref}.npy")
+                stages.append(
+                    stage(
+                        f"{name}/evaluation",
+                        "evaluation.py",
+                        [
+                            "--trajectory",
+                            aligned,
+                            "--wifi",
+                            session["wifi"],
+                            "--dataset",
+                            ref_dataset,
+                            "--output",
+                            errors,
+                        ],
+                        [aligned, session["wifi"], ref_dataset],
+                        [errors],
+                    )
+                )
+
+    return stages
+
+
+def is_inside(path, parent):
+    """whether path is parent or inside it"""
+    path = osp.abspath(path)
+    parent = osp.abspath(parent)
+    return path == parent or path.startswith(parent + os.sep)
+
+
+def dependencies(stages):
+    """Map each stage name to the names of the stages producing its inputs"""
+    deps = {}
+    for s in stages:
+        deps[s["name"]] = set()
+        for other in stages:
+            if other is s:
+                continue
+            if any(
+                is_inside(i, o) or is_inside(o, i)
+                for i in s["inputs"]
+                for o in other["outputs"]
+            ):
+                deps[s["name"]].add(other["name"])
+    return deps
+
+
+def list_files(path):
+    """files of a path, recursively if it is a directory. hidden files are
+    caches of other tools and are skipped"""
+    if not osp.isdir(path):
+        return [path]
+    files = []
+    for root, dirs, names in os.walk(path):
+        dirs[:] = sorted(d for d in dirs if not d.startswith("."))
+        files.extend(osp.join(root, n) for n in sorted(names) if not n.startswith("."))
+    return files
+
+
+def fingerprint(s, state_dir):
+    """fingerprint of the command and the content of the inputs of a stage"""
+    inputs = []
+    for path in s["inputs"]:
+        for file in list_files(path):
+            inputs.append((osp.abspath(file), cache.file_digest(file, state_dir)))
+    return cache.cache_key(s["cmd"], inputs)
+
+
+def state_file(s, state_dir):
+    return osp.join(state_dir, "stages", s["name"].replace("/", "__") + ".json")
+
+
+def is_current(s, key, state_dir):
+    """whether the outputs of a stage are up to date"""
+    if not all(osp.exists(o) for o in s["outputs"]):
+        return False
+    if not osp.exists(state_file(s, state_dir)):
+        return False
+    with open(state_file(s, state_dir), encoding="utf-8") as f:
+        return json.load(f)["fingerprint"] == key
+
+
+def run_stage(s, state_dir):
+    """Run a stage if its outputs are not up to date
+
+    Returns:
+        str: "skipped", "dry run" or "done"
+    """
+    key = fingerprint(s, state_dir)
+    if is_current(s, key, state_dir):
+        return "skipped"
+    if args.dry_run:
+        return "dry run"
+
+    # stale outputs would be picked up as caches, e.g. --fast_cache
+    for o in s["outputs"]:
+        if osp.isdir(o):
+            shutil.rmtree(o)
+        elif osp.exists(o):
+            os.remove(o)
+        if osp.splitext(o)[1] == "":
+            os.makedirs(o, exist_ok=True)
+        else:
+            os.makedirs(osp.dirname(o) or ".", exist_ok=True)
+
+    log_file = osp.join(state_dir, "logs", s["name"].replace("/", "__") + ".log")
+    os.makedirs(osp.dirname(log_file), exist_ok=True)
+    start = time.time()
+    with open(log_file, "w", encoding="utf-8") as log:
+        subprocess.run(s["cmd"], stdout=log, stderr=subprocess.STDOUT, check=True)
+
+    os.makedirs(osp.dirname(state_file(s, state_dir)), exist_ok=True)
+    with open(state_file(s, state_dir), "w", encoding="utf-8") as f:
+        json.dump(
+            {"fingerprint": key, "cmd": s["cmd"], "time": time.time() - start}, f
+        )
+    return "done"
+
+
+def main():
+    """Main function"""
+    with open(args.config, encoding="utf-8") as f:
+        config = json.load(f)
+
+    state_dir = osp.join(config["processed"], ".pipeline")
+    stages = build_stages(config)
+    deps = dependencies(stages)
+    by_name = {s["name"]: s for s in stages}
+
+    results = {}
+    failed = set()
+    pending = [s["name"] for s in stages]
+    running = {}
+
+    with ThreadPoolExecutor(max_workers=args.num_workers) as executor:
+        while pending or running:
+            # stages whose dependencies failed can not run
+            for name in list(pending):
+                if deps[name] & failed:
+                    print(f"{name}: not run, dependency failed")
+                    failed.add(name)
+                    pending.remove(name)
+
+            for name in list(pending):
+                if not deps[name] <= results.keys():
+                    continue
+                pending.remove(name)
+                if any(results[dep] == "dry run" for dep in deps[name]):
+                    # inputs are not produced yet, so it would run as well
+                    results[name] = "dry run"
+                    print(f"{name}: dry run")
+                    continue
+                future = executor.submit(run_stage, by_name[name], state_dir)
+                running[future] = name
+
+            if not running:
+                continue
+
+            done, _ = wait(running.keys(), return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                    print(f"{name}: {results[name]}")
+                except subprocess.CalledProcessError as e:
+                    print(f"{name}: failed with exit code {e.returncode}")
+                    failed.add(name)
+
+    if failed:
+        print(f"{len(failed)} stages failed, logs are in {state_dir}/logs")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -31,7 +31,7 @@ def main():
     # visualize a box (0,0,0) -> (1,1,1)
     unit_block = o3dobj.get_o3d_unit_block_at_origin()
     # trajectory
-    points, _ = io.load_coordinates_and_timestamps(trajectory_file_path)
+    points, _ = io.load_trajectory(trajectory_file_path)
     trajectory = o3dobj.get_o3d_trajectory_object(points, color=[1, 0, 0])
 
     # Visualize point cloud
@@ -5,12 +5,17 @@ import os.path as osp
 import time
 import open3d as o3d
 import numpy as np
+import pandas as pd
 import copy
 import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
 
 from utils import o3dobj
 from utils import io
 from utils import tfm
+from utils import cache
+from utils import features
+from utils import metrics
 
 
 parser = argparse.ArgumentParser()
@@ -42,13 +47,15 @@ parser.add_argument(
     "--fast_cache",
     type=str,
     default="",
-    help="transformation cache of fast global registration if available. default is none",
+    help="transformation cache of fast global registration if available,"
+    " written after running it otherwise. default is none",
 )
 parser.add_argument(
     "--icp_cache",
     type=str,
     default="",
-    help="transformation cache of icp if available. default is none",
+    help="transformation cache of icp if available, written after running it"
+    " otherwise. default is none",
 )
 parser.add_argument(
     "--voxel_size_fgr",
@@ -62,14 +69,70 @@ parser.add_argument(
     default=0.05,
     help="voxel size for icp downsampling. default is 0.05",
 )
+parser.add_argument(
+    "--cache_dir",
+    type=str,
+    default="",
+    help="cache directory of downsampled point clouds with normals and their FPFH"
+    " features. default is none",
+)
+parser.add_argument(
+    "--cache_max_gb",
+    type=float,
+    default=10.0,
+    help="size budget of the cache in GB, least recently used entries are evicted."
+    " default is 10",
+)
+parser.add_argument(
+    "--backend",
+    type=str,
+    default="legacy",
+    choices=["legacy", "tensor"],
+    help="open3d API of reading, downsampling, normals, FPFH features and ICP:"
+    " legacy, or tensor (open3d.t) with float32 storage on CPU. FGR always runs on"
+    " legacy clouds. default is legacy",
+)
 parser.add_argument("--skip_icp", action="store_true", help="skip icp and only run fgr")
+parser.add_argument(
+    "--no_display", action="store_true", help="do not display the previews"
+)
 parser.add_argument(
     "--transformed_trajectory_out",
     type=str,
     default="trajectory_1.jsonl",
-    help="output trajectory of the transformed trajectory 1 (to trajectory 2)",
+    help="output trajectory of the transformed trajectory 1 (to trajectory 2)."
+    " use .traj for binary",
+)
+parser.add_argument(
+    "--batch_sources",
+    type=str,
+    nargs="+",
+    default=[],
+    help="processed session directories with pc.ply and trajectory.jsonl (or"
+    " trajectory.traj), all registered to pointcloud2 instead of pointcloud1."
+    " outputs are written to each directory. default is none",
+)
+parser.add_argument(
+    "--num_workers",
+    type=int,
+    default=1,
+    help="number of sessions registered in parallel in batch mode. default is 1",
+)
+parser.add_argument(
+    "--batch_summary",
+    type=str,
+    default="registration_summary.csv",
+    help="summary table of batch mode. default is registration_summary.csv",
+)
+parser.add_argument(
+    "--metrics_out",
+    type=str,
+    default="",
+    help="JSON lines file the records of every stage (wall and CPU time, points,"
+    " fitness, inlier RMSE, iterations, peak RSS) are appended to. default is none",
 )
 args = parser.parse_args()
+metrics.set_output(args.metrics_out)
 
 pointcloud_file_path_1 = args.pointcloud1
 pointcloud_file_path_2 = args.pointcloud2
@@ -77,35 +140,82 @@ trajectory_file_path_1 = args.trajectory1
 trajectory_file_path_2 = args.trajectory2
 
 
-def preprocess_point_cloud(pcd, voxel_size):
-    """Downsamples the point cloud and computes the normals and FPFH features"""
-    print(f":: Downsample with a voxel size {voxel_size:.3f}.")
-    pcd_down = pcd.voxel_down_sample(voxel_size)
-
+def preprocess_point_cloud(pcd, voxel_size, source_key=None):
+    """Downsamples the point cloud and computes the normals, in a feature store
+    whose FPFH features are computed on first use (see fpfh_feature). tensor
+    clouds (--backend tensor) are processed with open3d.t throughout.
+    Downsampling, normals and FPFH features are cached in --cache_dir if
+    source_key is given"""
     radius_normal = voxel_size * 2
+    print(f":: Downsample with a voxel size {voxel_size:.3f}.")
     print(f":: Estimate normal with search radius {radius_normal:.3f}.")
-    pcd_down.estimate_normals(
-        o3d.geometry.KDTreeSearchParamHybrid(radius=radius_normal, max_nn=30)
+    pcd_down = cache.voxel_down_sample(
+        pcd,
+        voxel_size,
+        source_key,
+        cache_dir=args.cache_dir if source_key is not None else "",
+        max_bytes=int(args.cache_max_gb * 1e9),
+        radius_normal=radius_normal,
+        max_nn=30,
+    )
+    cloud_key = None
+    if source_key is not None:
+        cloud_key = cache.cache_key(source_key, voxel_size, radius_normal, 30)
+        if args.backend != "legacy":
+            cloud_key = cache.cache_key(cloud_key, args.backend)
+    return features.feature_store(args.backend)(
+        pcd_down,
+        radius_normal,
+        max_nn=30,
+        key=cloud_key,
+        cache_dir=args.cache_dir,
+        max_bytes=int(args.cache_max_gb * 1e9),
     )
 
+
+def read_point_cloud(file):
+    """Reads a point cloud with --backend, with a stage record"""
+    started = metrics.start()
+    cloud = features.read_point_cloud(file, args.backend)
+    metrics.record("load", started, file=file, points=metrics.num_points(cloud))
+    return cloud
+
+
+def fpfh_feature(store, voxel_size):
+    """FPFH features of a preprocessed point cloud"""
     radius_feature = voxel_size * 5
     print(f":: Compute FPFH feature with search radius {radius_feature:.3f}.")
-    pcd_fpfh = o3d.pipelines.registration.compute_fpfh_feature(
-        pcd_down,
-        o3d.geometry.KDTreeSearchParamHybrid(radius=radius_feature, max_nn=100),
-    )
-    return pcd_down, pcd_fpfh
+    return store.fpfh(radius_feature, max_nn=100)
 
 
-def prepare_dataset(voxel_size):
-    """Loads two point clouds and downsamples them."""
-    print(":: Load two point clouds")
-    source = o3d.io.read_point_cloud(pointcloud_file_path_1)
-    target = o3d.io.read_point_cloud(pointcloud_file_path_2)
+def prepare_dataset(voxel_sizes):
+    """Loads two point clouds once and downsamples them to every voxel size.
+    FPFH features are only computed by the stages that use them (fpfh_feature)
+
+    Args:
+        voxel_sizes (list[float]): voxel sizes, e.g. of FGR and ICP
 
-    source_down, source_fpfh = preprocess_point_cloud(source, voxel_size)
-    target_down, target_fpfh = preprocess_point_cloud(target, voxel_size)
-    return source, target, source_down, target_down, source_fpfh, target_fpfh
+    Returns:
+        source, target, dict voxel size -> (source store, target store)
+    """
+    print(":: Load two point clouds")
+    source = read_point_cloud(pointcloud_file_path_1)
+    target = read_point_cloud(pointcloud_file_path_2)
+
+    source_key, target_key = None, None
+    if args.cache_dir != "":
+        source_key = cache.file_digest(pointcloud_file_path_1, args.cache_dir)
+        target_key = cache.file_digest(pointcloud_file_path_2, args.cache_dir)
+
+    stores = {}
+    for voxel_size in voxel_sizes:
+        if voxel_size in stores:
+            continue
+        stores[voxel_size] = (
+            preprocess_point_cloud(source, voxel_size, source_key),
+            preprocess_point_cloud(target, voxel_size, target_key),
+        )
+    return source, target, stores
 
 
 def execute_fast_global_registration(
@@ -116,50 +226,235 @@ def execute_fast_global_registration(
     print(
         f":: Apply fast global registration with distance threshold {distance_threshold:.3f}"
     )
+    started = metrics.start()
+    option = o3d.pipelines.registration.FastGlobalRegistrationOption(
+        maximum_correspondence_distance=distance_threshold
+    )
     result = o3d.pipelines.registration.registration_fgr_based_on_feature_matching(
-        source_down,
-        target_down,
-        source_fpfh,
-        target_fpfh,
-        o3d.pipelines.registration.FastGlobalRegistrationOption(
-            maximum_correspondence_distance=distance_threshold
-        ),
+        source_down, target_down, source_fpfh, target_fpfh, option
+    )
+    metrics.record(
+        "fgr",
+        started,
+        source_points=len(source_down.points),
+        target_points=len(target_down.points),
+        distance=distance_threshold,
+        max_iteration=option.iteration_number,
+        **metrics.result_fields(result),
     )
     return result
 
 
-def execute_vanilla_icp(source, target):
-    """Performs vanilla ICP on the point clouds"""
-    estimation = o3d.pipelines.registration.TransformationEstimationPointToPlane()
+def execute_vanilla_icp(source, target, init=None, max_correspondence_distance=0.5):
+    """Performs vanilla point-to-plane ICP on the point clouds (legacy or
+    tensor), starting from init (identity if None). Returns the transformation
+    and the result"""
+    if init is None:
+        init = np.identity(4)
+    return features.icp(
+        source, target, max_correspondence_distance, init, max_iteration=50
+    )
+
+
+_batch_reference = None
+
 
-    max_correspondence_distance = 0.5
-    # Convergence-Criteria for Vanilla ICP
-    criteria = o3d.pipelines.registration.ICPConvergenceCriteria(
-        relative_fitness=0.000001, relative_rmse=0.000001, max_iteration=50
+def _init_batch_pool(reference_clouds, reference_fpfh):
+    """Process pool initializer, the preprocessed reference is sent once per
+    worker, as arrays, and kept in feature stores of --backend"""
+    global _batch_reference
+    clouds = {
+        voxel_size: features.feature_store(args.backend)(
+            io.cloud_from_arrays(*arrays, backend=args.backend)
+        )
+        for voxel_size, arrays in reference_clouds.items()
+    }
+    fpfh = None
+    if reference_fpfh is not None:
+        fpfh = o3d.pipelines.registration.Feature()
+        fpfh.data = reference_fpfh
+    _batch_reference = (clouds, fpfh)
+
+
+def _batch_outputs(session_dir):
+    """aligned trajectory, FGR and ICP transformation files of a batch session,
+    named after the directory of the reference point cloud"""
+    ref = osp.basename(osp.dirname(osp.abspath(pointcloud_file_path_2)))
+    return (
+        osp.join(session_dir, f"trajectory_alignedto_{ref}.jsonl"),
+        osp.join(session_dir, f"registration_fgr_to_{ref}.npy"),
+        osp.join(session_dir, f"registration_icp_to_{ref}.npy"),
     )
 
-    result = o3d.pipelines.registration.registration_icp(
-        source,
-        target,
-        max_correspondence_distance,
-        estimation_method=estimation,
-        criteria=criteria,
+
+def _session_trajectory(session_dir):
+    """trajectory file of a processed session, the binary trajectory.traj if
+    present, trajectory.jsonl otherwise"""
+    traj_file = osp.join(session_dir, "trajectory" + io.TRAJECTORY_EXT)
+    if osp.exists(traj_file):
+        return traj_file
+    return osp.join(session_dir, "trajectory.jsonl")
+
+
+def register_session(session_dir):
+    """Register a processed session to the batch reference: FGR and ICP unless
+    their transformation files exist, then the aligned trajectory
+
+    Args:
+        session_dir (str): directory with pc.ply and trajectory.jsonl (or .traj)
+
+    Returns:
+        dict: summary row, i.e. fitness, inlier RMSE and time of each stage
+    """
+    reference, reference_fpfh = _batch_reference
+    aligned_file, fgr_file, icp_file = _batch_outputs(session_dir)
+    row = {"session": osp.basename(osp.abspath(session_dir))}
+    start = time.time()
+
+    pointcloud_file = osp.join(session_dir, "pc.ply")
+    source = read_point_cloud(pointcloud_file)
+    source_key = None
+    if args.cache_dir != "":
+        source_key = cache.file_digest(pointcloud_file, args.cache_dir)
+    stores = {
+        voxel_size: preprocess_point_cloud(source, voxel_size, source_key)
+        for voxel_size in reference
+    }
+    del source
+    row["points"] = metrics.num_points(stores[args.voxel_size_fgr].cloud)
+
+    # FGR
+    fgr_start = time.time()
+    source_down = stores[args.voxel_size_fgr].legacy()
+    distance_threshold = args.voxel_size_fgr * 0.5
+    if osp.exists(fgr_file):
+        transformation_fast = np.load(fgr_file, allow_pickle=True)
+        result_fast = o3d.pipelines.registration.evaluate_registration(
+            source_down,
+            reference[args.voxel_size_fgr].legacy(),
+            distance_threshold,
+            transformation_fast,
+        )
+    else:
+        result_fast = execute_fast_global_registration(
+            source_down,
+            reference[args.voxel_size_fgr].legacy(),
+            fpfh_feature(stores[args.voxel_size_fgr], args.voxel_size_fgr),
+            reference_fpfh,
+            args.voxel_size_fgr,
+        )
+        transformation_fast = result_fast.transformation
+        np.save(fgr_file, transformation_fast)
+    row["fgr_fitness"] = result_fast.fitness
+    row["fgr_rmse"] = result_fast.inlier_rmse
+    row["fgr_time"] = time.time() - fgr_start
+
+    # ICP
+    transformation_icp = np.identity(4)
+    if not args.skip_icp:
+        icp_start = time.time()
+        if osp.exists(icp_file):
+            transformation_icp = np.load(icp_file, allow_pickle=True)
+            result_icp = o3d.pipelines.registration.evaluate_registration(
+                stores[args.voxel_size_icp].legacy(),
+                reference[args.voxel_size_icp].legacy(),
+                0.5,
+                np.dot(transformation_icp, transformation_fast),
+            )
+        else:
+            transformation, result_icp = execute_vanilla_icp(
+                stores[args.voxel_size_icp].cloud,
+                reference[args.voxel_size_icp].cloud,
+                transformation_fast,
+            )
+            transformation_icp = np.dot(
+                transformation, np.linalg.inv(transformation_fast)
+            )
+            np.save(icp_file, transformation_icp)
+        row["icp_fitness"] = result_icp.fitness
+        row["icp_rmse"] = result_icp.inlier_rmse
+        row["icp_time"] = time.time() - icp_start
+
+    started = metrics.start()
+    points, timestamps = io.load_trajectory(_session_trajectory(session_dir))
+    tfm.apply_transformation(
+        points, tfm.compose_transformations(transformation_fast, transformation_icp)
     )
-    return result
+    io.save_coodinates_and_timestamps(aligned_file, points, timestamps)
+    metrics.record("transform_save", started, file=aligned_file, points=len(points))
 
+    row["time"] = time.time() - start
+    return row
 
-if __name__ == "__main__":
+
+def main_batch():
+    """Main function of batch mode"""
+    run_started = metrics.start()
+    voxel_sizes = [args.voxel_size_fgr]
+    if not args.skip_icp:
+        voxel_sizes.append(args.voxel_size_icp)
+
+    print(":: Load the reference point cloud")
+    target = read_point_cloud(pointcloud_file_path_2)
+    target_key = None
+    if args.cache_dir != "":
+        target_key = cache.file_digest(pointcloud_file_path_2, args.cache_dir)
+    stores = {
+        voxel_size: preprocess_point_cloud(target, voxel_size, target_key)
+        for voxel_size in voxel_sizes
+    }
+    del target
+
+    # FPFH of the reference, only if a session still needs FGR
+    reference_fpfh = None
+    if any(not osp.exists(_batch_outputs(d)[1]) for d in args.batch_sources):
+        reference_fpfh = np.asarray(
+            fpfh_feature(stores[args.voxel_size_fgr], args.voxel_size_fgr).data
+        )
+    reference = (
+        {
+            voxel_size: io.cloud_to_arrays(store.cloud)
+            for voxel_size, store in stores.items()
+        },
+        reference_fpfh,
+    )
+
+    if args.num_workers <= 1:
+        _init_batch_pool(*reference)
+        rows = [register_session(d) for d in args.batch_sources]
+    else:
+        with ProcessPoolExecutor(
+            max_workers=args.num_workers,
+            initializer=_init_batch_pool,
+            initargs=reference,
+        ) as executor:
+            rows = list(executor.map(register_session, args.batch_sources))
+
+    summary = pd.DataFrame(rows)
+    print(summary.to_string(index=False, float_format="%.4f"))
+    summary.to_csv(args.batch_summary, index=False)
+    metrics.record(
+        "run",
+        run_started,
+        script="registration",
+        args=vars(args),
+        sessions=len(args.batch_sources),
+    )
+
+
+def main():
+    """Main function"""
+    run_started = metrics.start()
     voxel_size_fgr = args.voxel_size_fgr
     voxel_size_icp = args.voxel_size_icp
 
-    (
-        cloud_1,
-        cloud_2,
-        cloud_1_down,
-        cloud_2_down,
-        cloud_1_fpfh,
-        cloud_2_fpfh,
-    ) = prepare_dataset(voxel_size=voxel_size_fgr)
+    voxel_sizes = [voxel_size_fgr]
+    if not args.skip_icp:
+        voxel_sizes.append(voxel_size_icp)
+    cloud_1, cloud_2, stores = prepare_dataset(voxel_sizes)
+    store_1, store_2 = stores[voxel_size_fgr]
+    cloud_1_down = store_1.legacy()
+    cloud_2_down = store_2.legacy()
 
     color_1 = [0.9450980392, 0.5764705882, 0.7098039216]
     color_2 = [0.11, 0.72, 0.89]
@@ -176,8 +471,11 @@ if __name__ == "__main__":
     unit_block = o3dobj.get_o3d_unit_block_at_origin()
 
     # Visualize point cloud
-    print("Initial preview ... Close window to continue")
-    o3d.visualization.draw_geometries([cloud_1_down, cloud_2_down, axis, unit_block])
+    if not args.no_display:
+        print("Initial preview ... Close window to continue")
+        o3d.visualization.draw_geometries(
+            [cloud_1_down, cloud_2_down, axis, unit_block]
+        )
 
     # FGR
     transformation_fast = None
@@ -196,33 +494,34 @@ if __name__ == "__main__":
             o3d.utility.VerbosityLevel.Debug
         ) as cm:
             result_fast = execute_fast_global_registration(
-                cloud_1_down, cloud_2_down, cloud_1_fpfh, cloud_2_fpfh, voxel_size_fgr
+                cloud_1_down,
+                cloud_2_down,
+                fpfh_feature(store_1, voxel_size_fgr),
+                fpfh_feature(store_2, voxel_size_fgr),
+                voxel_size_fgr,
             )
 
         print(f"Fast global registration took {(time.time() - start):.3f} sec.\n")
         print(result_fast)
 
         transformation_fast = result_fast.transformation
-        np.save("registration_fgr.npy", transformation_fast)
+        np.save(
+            args.fast_cache if args.fast_cache != "" else "registration_fgr.npy",
+            transformation_fast,
+        )
 
     cloud_1.transform(transformation_fast)
 
     # Visualize point cloud
-    print("FGR preview ... Close window to continue")
-    o3d.visualization.draw_geometries([cloud_1, cloud_2, axis, unit_block])
+    if not args.no_display:
+        print("FGR preview ... Close window to continue")
+        o3d.visualization.draw_geometries(
+            [features.to_legacy(cloud_1), features.to_legacy(cloud_2), axis, unit_block]
+        )
 
     # Vanilla ICP
     if not args.skip_icp:
-        (
-            _,
-            _,
-            cloud_1_down,
-            cloud_2_down,
-            _,
-            _,
-        ) = prepare_dataset(voxel_size=voxel_size_icp)
-
-        cloud_1_down.transform(transformation_fast)
+        store_1, store_2 = stores[voxel_size_icp]
 
         transformation_icp = None
         if args.icp_cache != "":
@@ -238,7 +537,10 @@ if __name__ == "__main__":
             with o3d.utility.VerbosityContextManager(
                 o3d.utility.VerbosityLevel.Debug
             ) as cm:
-                result_icp = execute_vanilla_icp(cloud_1_down, cloud_2_down)
+                # from the FGR result, the downsampled clouds stay as they are
+                transformation, result_icp = execute_vanilla_icp(
+                    store_1.cloud, store_2.cloud, transformation_fast
+                )
 
             icp_time = time.time() - s
 
@@ -246,29 +548,35 @@ if __name__ == "__main__":
             print("Inlier Fitness: ", result_icp.fitness)
             print("Inlier RMSE: ", result_icp.inlier_rmse)
 
-            transformation_icp = result_icp.transformation
-            np.save("registration_icp.npy", transformation_icp)
+            transformation_icp = np.dot(
+                transformation, np.linalg.inv(transformation_fast)
+            )
+            np.save(
+                args.icp_cache if args.icp_cache != "" else "registration_icp.npy",
+                transformation_icp,
+            )
 
         cloud_1.transform(transformation_icp)
     else:
         transformation_icp = np.identity(4)
 
+    started = metrics.start()
     if trajectory_file_path_1 != "":
         # trajectory
-        points_1, timestamps_1 = io.load_coordinates_and_timestamps(
-            trajectory_file_path_1
-        )
+        points_1, timestamps_1 = io.load_trajectory(trajectory_file_path_1)
 
         # transformation
-        points_1 = tfm.transform_trajectory(points_1, transformation_fast)
-        points_1 = tfm.transform_trajectory(points_1, transformation_icp)
+        tfm.apply_transformation(
+            points_1,
+            tfm.compose_transformations(transformation_fast, transformation_icp),
+        )
 
         trajectory_1 = o3dobj.get_o3d_trajectory_object(points_1, color=[1, 0, 0])
     else:
         trajectory_1 = None
 
     if trajectory_file_path_2 != "":
-        points_2, _ = io.load_coordinates_and_timestamps(trajectory_file_path_2)
+        points_2, _ = io.load_trajectory(trajectory_file_path_2)
         trajectory_2 = o3dobj.get_o3d_trajectory_object(points_2, color=[0, 1, 0])
     else:
         trajectory_2 = None
@@ -277,10 +585,30 @@ if __name__ == "__main__":
     io.save_coodinates_and_timestamps(
         args.transformed_trajectory_out, points_1, timestamps_1
     )
+    metrics.record(
+        "transform_save",
+        started,
+        file=args.transformed_trajectory_out,
+        points=len(points_1),
+    )
+    metrics.record("run", run_started, script="registration", args=vars(args))
 
-    disp = [cloud_1, cloud_2, axis, unit_block, trajectory_1, trajectory_2]
+    # Visualize point cloud
+    if not args.no_display:
+        disp = [
+            features.to_legacy(cloud_1),
+            features.to_legacy(cloud_2),
+            axis,
+            unit_block,
+            trajectory_1,
+            trajectory_2,
+        ]
+        disp = [x for x in disp if x is not None]
+        o3d.visualization.draw_geometries(disp)
 
-    disp = [x for x in disp if x is not None]
 
-    # Visualize point cloud
-    o3d.visualization.draw_geometries(disp)
+if __name__ == "__main__":
+    if args.batch_sources:
+        main_batch()
+    else:
+        main()
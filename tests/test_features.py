@@ -0,0 +1,37 @@
+import numpy as np
+import open3d as o3d
+
+from utils import features
+
+
+def _clouds(backend, offset):
+    """a random cloud and a copy moved by offset, with normals"""
+    points = np.random.default_rng(0).random((500, 3))
+    clouds = []
+    for p in (points, points + offset):
+        cloud = o3d.geometry.PointCloud(o3d.utility.Vector3dVector(p))
+        if backend == "tensor":
+            cloud = features.to_tensor(cloud)
+        cloud.estimate_normals()
+        clouds.append(cloud)
+    return clouds
+
+
+def test_information_matrix_without_overlap():
+    for backend in ("legacy", "tensor"):
+        source, target = _clouds(backend, 100.0)
+        transformation, result = features.icp(source, target, 0.1, np.identity(4))
+        assert result.fitness == 0
+        for icp_result in (result, None):
+            information = features.information_matrix(
+                source, target, 0.1, transformation, icp_result
+            )
+            assert np.array_equal(information, np.zeros((6, 6)))
+
+
+def test_information_matrix_with_overlap():
+    for backend in ("legacy", "tensor"):
+        source, target = _clouds(backend, 0.0)
+        information = features.information_matrix(source, target, 0.1, np.identity(4))
+        assert information.shape == (6, 6)
+        assert information[3, 3] > 0
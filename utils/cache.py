@@ -0,0 +1,350 @@
+import hashlib
+import json
+import os
+import os.path as osp
+import threading
+import open3d as o3d
+import numpy as np
+
+from utils import metrics
+
+
+def _tmp_file(file):
+    """temporary file next to file, unique per process and thread, so that
+    concurrent writers never share it before renaming"""
+    return f"{file}.{os.getpid()}.{threading.get_ident()}.tmp"
+
+
+def cache_key(*parts):
+    """build a cache key from strings, numbers, None, lists and numpy arrays
+
+    Returns:
+        str: hex digest
+    """
+    hasher = hashlib.sha1()
+    for part in parts:
+        if isinstance(part, np.ndarray):
+            part = np.ascontiguousarray(part)
+            hasher.update(f"ndarray{part.dtype.str}{part.shape}".encode())
+            hasher.update(part.tobytes())
+        elif isinstance(part, (list, tuple)):
+            hasher.update(cache_key(*part).encode())
+        else:
+            hasher.update(repr(part).encode())
+        hasher.update(b"|")
+    return hasher.hexdigest()
+
+
+def file_digest(file, cache_dir=""):
+    """content hash of a file, None if the file does not exist.
+    if cache_dir is given, the digest is remembered there and only recomputed
+    when the mtime or size of the file changes
+
+    Args:
+        file (str): file dir
+        cache_dir (str, optional): cache directory. Defaults to "", i.e. no memo.
+    """
+    if not osp.exists(file):
+        return None
+
+    stat = os.stat(file)
+    stamp = [stat.st_mtime_ns, stat.st_size]
+    memo_file = None
+    if cache_dir != "":
+        memo_file = osp.join(
+            cache_dir, "digests", cache_key(osp.abspath(file)) + ".json"
+        )
+        if osp.exists(memo_file):
+            with open(memo_file, encoding="utf-8") as f:
+                memo = json.load(f)
+            if memo["stamp"] == stamp:
+                return memo["digest"]
+
+    hasher = hashlib.sha1()
+    with open(file, "rb") as f:
+        while True:
+            chunk = f.read(1 << 24)
+            if not chunk:
+                break
+            hasher.update(chunk)
+    digest = hasher.hexdigest()
+
+    if memo_file is not None:
+        os.makedirs(osp.dirname(memo_file), exist_ok=True)
+        tmp = _tmp_file(memo_file)
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"file": osp.abspath(file), "stamp": stamp, "digest": digest}, f)
+        os.replace(tmp, memo_file)
+
+    return digest
+
+
+# size of each cache directory as seen by this process, updated on save and
+# eviction, so that the directory is only walked when it may be over budget
+_cache_bytes = {}
+
+
+def _entry_file(cache_dir, kind, key):
+    return osp.join(cache_dir, kind, key + ".npz")
+
+
+def load_arrays(cache_dir, kind, key):
+    """load a cache entry and mark it as recently used
+
+    Args:
+        cache_dir (str): cache directory
+        kind (str): entry kind, i.e. sub directory
+        key (str): cache key
+
+    Returns:
+        dict of numpy arrays, None if not cached
+    """
+    entry = _entry_file(cache_dir, kind, key)
+    # another process may evict the entry at any time, so no exists check
+    try:
+        with np.load(entry) as data:
+            arrays = {name: data[name] for name in data.files}
+        # mtime is the last use time for LRU eviction
+        os.utime(entry)
+    except FileNotFoundError:
+        return None
+    return arrays
+
+
+def save_arrays(cache_dir, kind, key, max_bytes, **arrays):
+    """save a cache entry, then evict least recently used entries if the cache
+    is over max_bytes (see evict). the size of the cache is tracked per
+    process, it is only walked on the first save and on eviction
+
+    Args:
+        cache_dir (str): cache directory
+        kind (str): entry kind, i.e. sub directory
+        key (str): cache key
+        max_bytes (int): size budget of the whole cache, None for no limit
+        arrays: numpy arrays to save
+    """
+    entry = _entry_file(cache_dir, kind, key)
+    os.makedirs(osp.dirname(entry), exist_ok=True)
+    # write then rename, so other processes never see partial entries
+    tmp = _tmp_file(entry)
+    with open(tmp, "wb") as f:
+        np.savez(f, **arrays)
+    size = osp.getsize(tmp)
+    os.replace(tmp, entry)
+
+    if max_bytes is None:
+        return
+    if cache_dir in _cache_bytes:
+        _cache_bytes[cache_dir] += size
+    else:
+        _cache_bytes[cache_dir] = sum(size for _, size, _ in _cache_entries(cache_dir))
+    if _cache_bytes[cache_dir] > max_bytes:
+        evict(cache_dir, max_bytes)
+
+
+def _cache_entries(cache_dir):
+    """(mtime, size, file) of every entry, skipping entries evicted meanwhile"""
+    entries = []
+    for root, _, files in os.walk(cache_dir):
+        for name in files:
+            if name.endswith(".npz"):
+                entry = osp.join(root, name)
+                try:
+                    stat = os.stat(entry)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime_ns, stat.st_size, entry))
+    return entries
+
+
+def evict(cache_dir, max_bytes, low_water=0.9):
+    """remove least recently used entries until the cache is within
+    low_water * max_bytes, so that the next eviction only comes after a share
+    of the budget is written again. entries removed by another process
+    meanwhile are skipped
+
+    Args:
+        cache_dir (str): cache directory
+        max_bytes (int): size budget of the whole cache
+        low_water (float, optional): share of max_bytes to evict down to, if
+            over max_bytes. Defaults to 0.9.
+    """
+    entries = _cache_entries(cache_dir)
+    total = sum(size for _, size, _ in entries)
+    if total > max_bytes:
+        # oldest first
+        entries.sort()
+        for _, size, entry in entries:
+            if total <= low_water * max_bytes:
+                break
+            print("evicting cache entry " + entry)
+            try:
+                os.remove(entry)
+            except FileNotFoundError:
+                pass
+            total -= size
+    _cache_bytes[cache_dir] = total
+
+
+def voxel_down_sample(
+    cloud,
+    voxel_size,
+    source_key,
+    cache_dir="",
+    max_bytes=None,
+    radius_normal=None,
+    max_nn=30,
+):
+    """voxel downsampling (and normal estimation) with a disk cache.
+    the cache entry is keyed on source_key and the parameters, so cloud itself
+    is only read on cache miss
+
+    Args:
+        cloud (o3d.geometry.PointCloud or o3d.t.geometry.PointCloud): cloud to
+            be downsampled, tensor clouds are downsampled with open3d.t
+        voxel_size (float): voxel size
+        source_key: identity of the cloud content, i.e. file digests and
+            applied transforms, see cache_key
+        cache_dir (str, optional): cache directory. Defaults to "", i.e. no cache.
+        max_bytes (int, optional): size budget of the cache. Defaults to None.
+        radius_normal (float, optional): if given, estimate normals with this
+            search radius after downsampling. Defaults to None.
+        max_nn (int, optional): max neighbors of normal estimation. Defaults to 30.
+
+    Returns:
+        o3d.geometry.PointCloud or o3d.t.geometry.PointCloud: downsampled cloud,
+            of the same kind as cloud
+    """
+    tensor = isinstance(cloud, o3d.t.geometry.PointCloud)
+    key = None
+    started = metrics.start()
+    if cache_dir != "":
+        key_parts = ["voxel_down_sample", source_key, voxel_size, radius_normal, max_nn]
+        if tensor:
+            # float32, and downsampled by another implementation
+            key_parts.append("tensor")
+        key = cache_key(*key_parts)
+        arrays = load_arrays(cache_dir, "clouds", key)
+        if arrays is not None:
+            print(f":: Loaded downsampled cloud from cache {key}")
+            if tensor:
+                cloud_down = o3d.t.geometry.PointCloud(
+                    o3d.core.Tensor(arrays["points"])
+                )
+                for name in ("colors", "normals"):
+                    if len(arrays[name]) > 0:
+                        cloud_down.point[name] = o3d.core.Tensor(arrays[name])
+            else:
+                cloud_down = o3d.geometry.PointCloud()
+                cloud_down.points = o3d.utility.Vector3dVector(arrays["points"])
+                if len(arrays["colors"]) > 0:
+                    cloud_down.colors = o3d.utility.Vector3dVector(arrays["colors"])
+                if len(arrays["normals"]) > 0:
+                    cloud_down.normals = o3d.utility.Vector3dVector(arrays["normals"])
+            metrics.record(
+                "downsample",
+                started,
+                voxel_size=voxel_size,
+                points=metrics.num_points(cloud_down),
+                cached=True,
+            )
+            return cloud_down
+
+    cloud_down = cloud.voxel_down_sample(voxel_size)
+    metrics.record(
+        "downsample",
+        started,
+        voxel_size=voxel_size,
+        input_points=metrics.num_points(cloud),
+        points=metrics.num_points(cloud_down),
+        cached=False,
+    )
+    if radius_normal is not None:
+        started = metrics.start()
+        if tensor:
+            cloud_down.estimate_normals(max_nn=max_nn, radius=radius_normal)
+        else:
+            cloud_down.estimate_normals(
+                o3d.geometry.KDTreeSearchParamHybrid(
+                    radius=radius_normal, max_nn=max_nn
+                )
+            )
+        metrics.record(
+            "normals",
+            started,
+            radius=radius_normal,
+            points=metrics.num_points(cloud_down),
+        )
+
+    if key is not None:
+        if tensor:
+            arrays = {
+                name: cloud_down.point[name].numpy()
+                if name in cloud_down.point
+                else np.empty((0, 3))
+                for name in ("positions", "colors", "normals")
+            }
+            arrays["points"] = arrays.pop("positions")
+        else:
+            arrays = {
+                "points": np.asarray(cloud_down.points),
+                "colors": np.asarray(cloud_down.colors),
+                "normals": np.asarray(cloud_down.normals),
+            }
+        save_arrays(cache_dir, "clouds", key, max_bytes, **arrays)
+
+    return cloud_down
+
+
+def fpfh_feature(cloud, radius, max_nn, cloud_key, cache_dir="", max_bytes=None):
+    """FPFH features with a disk cache, stored as float32. with a cache, computed
+    features go through float32 as well, so that hits and misses give the same
+    registration
+
+    Args:
+        cloud (o3d.geometry.PointCloud or o3d.t.geometry.PointCloud): cloud with
+            normals
+        radius (float): search radius
+        max_nn (int): max neighbors
+        cloud_key: identity of the cloud content, i.e. its source, downsampling
+            and normals, see cache_key
+        cache_dir (str, optional): cache directory. Defaults to "", i.e. no cache.
+        max_bytes (int, optional): size budget of the cache. Defaults to None.
+
+    Returns:
+        o3d.pipelines.registration.Feature: features
+    """
+    key = None
+    started = metrics.start()
+    points = metrics.num_points(cloud)
+    if cache_dir != "":
+        key = cache_key("fpfh_feature", cloud_key, radius, max_nn)
+        arrays = load_arrays(cache_dir, "features", key)
+        if arrays is not None and arrays["data"].shape[1] == points:
+            print(f":: Loaded FPFH features from cache {key}")
+            feature = o3d.pipelines.registration.Feature()
+            feature.data = arrays["data"].astype(np.float64)
+            metrics.record("fpfh", started, radius=radius, points=points, cached=True)
+            return feature
+
+    if isinstance(cloud, o3d.t.geometry.PointCloud):
+        feature = o3d.pipelines.registration.Feature()
+        feature.data = (
+            o3d.t.pipelines.registration.compute_fpfh_feature(
+                cloud, max_nn=max_nn, radius=radius
+            )
+            .numpy()
+            .T.astype(np.float64)
+        )
+    else:
+        feature = o3d.pipelines.registration.compute_fpfh_feature(
+            cloud, o3d.geometry.KDTreeSearchParamHybrid(radius=radius, max_nn=max_nn)
+        )
+
+    if key is not None:
+        data = np.asarray(feature.data).astype(np.float32)
+        save_arrays(cache_dir, "features", key, max_bytes, data=data)
+        feature.data = data.astype(np.float64)
+
+    metrics.record("fpfh", started, radius=radius, points=points, cached=False)
+    return feature
@@ -0,0 +1,306 @@
+import open3d as o3d
+import numpy as np
+
+from utils import cache
+from utils import metrics
+
+
+class PointCloudFeatures:
+    """features of a point cloud computed once and shared by every registration
+    it takes part in, i.e. normals, decimated levels and FPFH features.
+
+    open3d builds the search index of the target inside each registration call
+    and offers no way to pass one in, so what is kept here is everything around
+    it: normals are estimated once, decimated levels and FPFH features are
+    computed on first use, and information matrices are taken from the
+    correspondences of the registration instead of a new search (see
+    information_matrix)
+
+    Args:
+        cloud (o3d.geometry.PointCloud): point cloud, normals are estimated in
+            place if missing
+        radius_normal (float, optional): search radius of normal estimation.
+            Defaults to None, i.e. max_nn nearest neighbors.
+        max_nn (int, optional): max neighbors of normal estimation. Defaults to 30.
+        key (optional): identity of the cloud content with its normals, see
+            cache.cache_key. FPFH features are cached on disk if key and
+            cache_dir are given. Defaults to None.
+        cache_dir (str, optional): cache directory. Defaults to "".
+        max_bytes (int, optional): size budget of the cache. Defaults to None.
+    """
+
+    def __init__(
+        self,
+        cloud,
+        radius_normal=None,
+        max_nn=30,
+        key=None,
+        cache_dir="",
+        max_bytes=None,
+    ):
+        self.cloud = cloud
+        self.max_nn = max_nn
+        self.key = key
+        self.cache_dir = cache_dir if key is not None else ""
+        self.max_bytes = max_bytes
+        if not cloud.has_normals():
+            started = metrics.start()
+            cloud.estimate_normals(_search_param(radius_normal, max_nn))
+            metrics.record(
+                "normals", started, radius=radius_normal, points=len(cloud.points)
+            )
+        self._levels = {}
+        self._fpfh = {}
+
+    def level(self, voxel_size):
+        """cloud decimated to voxel_size, with unit normals
+
+        Args:
+            voxel_size (float): voxel size
+
+        Returns:
+            o3d.geometry.PointCloud: decimated cloud
+        """
+        if voxel_size not in self._levels:
+            level = self.cloud.voxel_down_sample(voxel_size)
+            if level.has_normals():
+                # normals are averaged per voxel
+                level.normalize_normals()
+            else:
+                level.estimate_normals(_search_param(voxel_size * 2, self.max_nn))
+            self._levels[voxel_size] = level
+        return self._levels[voxel_size]
+
+    def fpfh(self, radius, max_nn=100):
+        """FPFH features of the cloud
+
+        Args:
+            radius (float): search radius
+            max_nn (int, optional): max neighbors. Defaults to 100.
+
+        Returns:
+            o3d.pipelines.registration.Feature: features
+        """
+        if (radius, max_nn) not in self._fpfh:
+            self._fpfh[(radius, max_nn)] = cache.fpfh_feature(
+                self.cloud, radius, max_nn, self.key, self.cache_dir, self.max_bytes
+            )
+        return self._fpfh[(radius, max_nn)]
+
+    def legacy(self):
+        """the cloud as o3d.geometry.PointCloud, e.g. for display"""
+        return self.cloud
+
+
+class TensorPointCloudFeatures(PointCloudFeatures):
+    """PointCloudFeatures on the tensor backend (open3d.t), with float32
+    storage on CPU. levels are tensor point clouds, FPFH features are computed
+    by the tensor pipeline and returned as legacy features for FGR
+
+    Args:
+        cloud (o3d.geometry.PointCloud or o3d.t.geometry.PointCloud): point
+            cloud, converted with to_tensor
+        see PointCloudFeatures for the other arguments
+    """
+
+    def __init__(
+        self,
+        cloud,
+        radius_normal=None,
+        max_nn=30,
+        key=None,
+        cache_dir="",
+        max_bytes=None,
+    ):
+        self.cloud = to_tensor(cloud)
+        self.max_nn = max_nn
+        self.key = key
+        self.cache_dir = cache_dir if key is not None else ""
+        self.max_bytes = max_bytes
+        if "normals" not in self.cloud.point:
+            started = metrics.start()
+            self.cloud.estimate_normals(max_nn=max_nn, radius=radius_normal)
+            metrics.record(
+                "normals",
+                started,
+                radius=radius_normal,
+                points=metrics.num_points(self.cloud),
+            )
+        self._levels = {}
+        self._fpfh = {}
+        self._legacy = None
+
+    def level(self, voxel_size):
+        if voxel_size not in self._levels:
+            level = self.cloud.voxel_down_sample(voxel_size)
+            if "normals" in level.point:
+                level.normalize_normals()
+            else:
+                level.estimate_normals(max_nn=self.max_nn, radius=voxel_size * 2)
+            self._levels[voxel_size] = level
+        return self._levels[voxel_size]
+
+    def legacy(self):
+        if self._legacy is None:
+            self._legacy = self.cloud.to_legacy()
+        return self._legacy
+
+
+def to_tensor(cloud):
+    """tensor point cloud on CPU with float32 attributes, colors in [0, 1]
+
+    Args:
+        cloud (o3d.geometry.PointCloud or o3d.t.geometry.PointCloud): point cloud
+
+    Returns:
+        o3d.t.geometry.PointCloud: point cloud, cloud itself if already float32
+    """
+    if not isinstance(cloud, o3d.t.geometry.PointCloud):
+        cloud = o3d.t.geometry.PointCloud.from_legacy(cloud, o3d.core.float32)
+    for name in list(cloud.point):
+        attribute = cloud.point[name]
+        if attribute.dtype == o3d.core.uint8:
+            # e.g. colors of o3d.t.io.read_point_cloud
+            cloud.point[name] = attribute.to(o3d.core.float32) / 255.0
+        elif attribute.dtype != o3d.core.float32:
+            cloud.point[name] = attribute.to(o3d.core.float32)
+    return cloud
+
+
+def read_point_cloud(file, backend="legacy"):
+    """read a point cloud with the given backend, "legacy" or "tensor"
+    (float32, see to_tensor)"""
+    if backend == "tensor":
+        return to_tensor(o3d.t.io.read_point_cloud(file))
+    return o3d.io.read_point_cloud(file)
+
+
+def to_legacy(cloud):
+    """cloud as o3d.geometry.PointCloud, e.g. for display"""
+    if isinstance(cloud, o3d.t.geometry.PointCloud):
+        return cloud.to_legacy()
+    return cloud
+
+
+def feature_store(backend="legacy"):
+    """feature store class of a backend, i.e. legacy or tensor"""
+    if backend == "tensor":
+        return TensorPointCloudFeatures
+    return PointCloudFeatures
+
+
+def icp(source, target, distance, init, max_iteration=30):
+    """point-to-plane ICP of two legacy or two tensor point clouds, converging
+    at a relative change of fitness and RMSE below 1e-6
+
+    Args:
+        source: source point cloud
+        target: target point cloud, with normals
+        distance (float): max correspondence distance
+        init (numpy.array): initial transformation
+        max_iteration (int, optional): max iterations. Defaults to 30.
+
+    Returns:
+        transformation (numpy.array), registration result
+    """
+    started = metrics.start()
+    if isinstance(source, o3d.t.geometry.PointCloud):
+        treg = o3d.t.pipelines.registration
+        result = treg.icp(
+            source,
+            target,
+            distance,
+            init,
+            treg.TransformationEstimationPointToPlane(),
+            treg.ICPConvergenceCriteria(
+                relative_fitness=0.000001,
+                relative_rmse=0.000001,
+                max_iteration=max_iteration,
+            ),
+        )
+        transformation = result.transformation.numpy()
+    else:
+        result = o3d.pipelines.registration.registration_icp(
+            source,
+            target,
+            distance,
+            init,
+            o3d.pipelines.registration.TransformationEstimationPointToPlane(),
+            criteria=o3d.pipelines.registration.ICPConvergenceCriteria(
+                relative_fitness=0.000001,
+                relative_rmse=0.000001,
+                max_iteration=max_iteration,
+            ),
+        )
+        transformation = result.transformation
+    metrics.record(
+        "icp",
+        started,
+        source_points=metrics.num_points(source),
+        target_points=metrics.num_points(target),
+        distance=distance,
+        max_iteration=max_iteration,
+        **metrics.result_fields(result),
+    )
+    return transformation, result
+
+
+def _search_param(radius, max_nn):
+    if radius is None:
+        return o3d.geometry.KDTreeSearchParamKNN(max_nn)
+    return o3d.geometry.KDTreeSearchParamHybrid(radius=radius, max_nn=max_nn)
+
+
+def information_matrix(source, target, distance, transformation, result=None):
+    """information matrix of a registration of legacy or tensor point clouds.
+    for legacy clouds with the ICP result at the same distance, it comes from
+    the correspondence set of the result, whose last correspondence search
+    already paired every source point with its nearest target point, instead
+    of a new search
+
+    Args:
+        source: source point cloud
+        target: target point cloud
+        distance (float): max correspondence distance
+        transformation (numpy.array): transformation
+        result (optional): ICP result at distance and transformation, see icp.
+            Defaults to None.
+
+    Returns:
+        numpy.array: 6x6 information matrix
+    """
+    if isinstance(source, o3d.t.geometry.PointCloud):
+        # same as legacy, no correspondences give a zero information matrix,
+        # where open3d.t raises instead
+        if result is not None and result.fitness == 0:
+            return np.zeros((6, 6))
+        try:
+            return o3d.t.pipelines.registration.get_information_matrix(
+                source, target, distance, transformation
+            ).numpy()
+        except RuntimeError as e:
+            if "0 correspondence" not in str(e):
+                raise
+            return np.zeros((6, 6))
+    if result is None:
+        return o3d.pipelines.registration.get_information_matrix_from_point_clouds(
+            source, target, distance, transformation
+        )
+
+    correspondences = np.asarray(result.correspondence_set)
+    if len(correspondences) == 0:
+        return np.zeros((6, 6))
+    points = np.asarray(target.points)[correspondences[:, 1]]
+    x, y, z = points[:, 0], points[:, 1], points[:, 2]
+    zero = np.zeros_like(x)
+    one = np.ones_like(x)
+    # (K, 3, 6) jacobians of the target points
+    jacobians = np.stack(
+        [
+            np.stack([zero, z, -y, one, zero, zero], axis=1),
+            np.stack([-z, zero, x, zero, one, zero], axis=1),
+            np.stack([y, -x, zero, zero, zero, one], axis=1),
+        ],
+        axis=1,
+    )
+    return np.einsum("kij,kil->jl", jacobians, jacobians)
@@ -3,14 +3,489 @@ import os
 import os.path as osp
 import open3d as o3d
 import json
+import re
 import numpy as np
 import time
 import datetime
 import pytz
+from concurrent.futures import ProcessPoolExecutor
+
+from utils import cache
+from utils import metrics
+from utils import tfm
+
+
+def cloud_to_arrays(cloud):
+    """convert an o3d point cloud, legacy or tensor, into (points, colors,
+    normals) numpy arrays. missing attributes are empty"""
+    if isinstance(cloud, o3d.t.geometry.PointCloud):
+        return tuple(
+            cloud.point[name].numpy() if name in cloud.point else np.empty((0, 3))
+            for name in ("positions", "colors", "normals")
+        )
+    return (
+        np.asarray(cloud.points),
+        np.asarray(cloud.colors),
+        np.asarray(cloud.normals),
+    )
+
+
+def cloud_from_arrays(points, colors, normals, backend="legacy"):
+    """build an o3d point cloud from (points, colors, normals) numpy arrays.
+    with backend "tensor", a tensor point cloud with float32 attributes is
+    built directly from the arrays"""
+    if backend == "tensor":
+        cloud = o3d.t.geometry.PointCloud(
+            o3d.core.Tensor(np.asarray(points, dtype=np.float32))
+        )
+        if len(colors) > 0:
+            cloud.point.colors = o3d.core.Tensor(np.asarray(colors, dtype=np.float32))
+        if len(normals) > 0:
+            cloud.point.normals = o3d.core.Tensor(
+                np.asarray(normals, dtype=np.float32)
+            )
+        return cloud
+
+    cloud = o3d.geometry.PointCloud()
+    cloud.points = o3d.utility.Vector3dVector(points)
+    if len(colors) > 0:
+        cloud.colors = o3d.utility.Vector3dVector(colors)
+    if len(normals) > 0:
+        cloud.normals = o3d.utility.Vector3dVector(normals)
+    return cloud
+
+
+def _read_ply_header(ply_file):
+    """read the header of a ply file
+
+    Args:
+        ply_file (str): ply file dir
+
+    Returns:
+        header_size: size of the header in bytes, i.e. offset of the data
+        fmt: ascii, binary_little_endian or binary_big_endian
+        elements: list of (name, count, [(property_name, property_type)]).
+            list properties have type "list"
+    """
+    fmt = None
+    elements = []
+    with open(ply_file, "rb") as f:
+        if f.readline().strip() != b"ply":
+            raise ValueError(f"not a ply file: {ply_file}")
+        while True:
+            line = f.readline()
+            if not line:
+                raise ValueError(f"ply header not terminated: {ply_file}")
+            words = line.decode("ascii").split()
+            if len(words) == 0:
+                continue
+            if words[0] == "format":
+                fmt = words[1]
+            elif words[0] == "element":
+                elements.append((words[1], int(words[2]), []))
+            elif words[0] == "property":
+                if words[1] == "list":
+                    elements[-1][2].append((words[-1], "list"))
+                else:
+                    elements[-1][2].append((words[2], words[1]))
+            elif words[0] == "end_header":
+                return f.tell(), fmt, elements
+
+
+_PLY_TYPES = {
+    "char": "i1",
+    "int8": "i1",
+    "uchar": "u1",
+    "uint8": "u1",
+    "short": "<i2",
+    "int16": "<i2",
+    "ushort": "<u2",
+    "uint16": "<u2",
+    "int": "<i4",
+    "int32": "<i4",
+    "uint": "<u4",
+    "uint32": "<u4",
+    "float": "<f4",
+    "float32": "<f4",
+    "double": "<f8",
+    "float64": "<f8",
+}
+
+
+def read_ply_vertices(ply_file):
+    """memory-map the vertex data of a binary little-endian ply file into a
+    numpy structured array, without parsing or copying it.
+    the vertex element should be the first element of the file
+
+    Args:
+        ply_file (str): ply file dir
+
+    Returns:
+        read-only np.memmap of shape (N,), fields named after the ply properties
+    """
+    header_size, fmt, elements = _read_ply_header(ply_file)
+    if fmt != "binary_little_endian":
+        raise ValueError(f"only binary_little_endian ply is supported: {ply_file}")
+    if len(elements) == 0 or elements[0][0] != "vertex":
+        raise ValueError(f"vertex should be the first ply element: {ply_file}")
+
+    _, count, properties = elements[0]
+    if any(prop_type == "list" for _, prop_type in properties):
+        raise ValueError(f"list properties of vertex are not supported: {ply_file}")
+
+    dtype = np.dtype([(name, _PLY_TYPES[prop_type]) for name, prop_type in properties])
+    if count == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(
+        ply_file, dtype=dtype, mode="r", offset=header_size, shape=(count,)
+    )
+
+
+def ply_vertex_view(vertices, names=("x", "y", "z")):
+    """(N, len(names)) array of some fields of a structured vertex array.
+    if the fields are adjacent and have the same type, this is a zero-copy
+    strided view, otherwise a copy
+
+    Args:
+        vertices: structured array, see read_ply_vertices
+        names (tuple, optional): field names. Defaults to ("x", "y", "z").
+    """
+    fields = [vertices.dtype.fields[name] for name in names]
+    field_dtype, offset = fields[0]
+    adjacent = all(
+        fields[i][0] == field_dtype
+        and fields[i][1] == offset + i * field_dtype.itemsize
+        for i in range(len(fields))
+    )
+    if not adjacent:
+        return np.stack([vertices[name] for name in names], axis=1)
+    return np.ndarray(
+        (len(vertices), len(names)),
+        dtype=field_dtype,
+        buffer=vertices,
+        offset=offset,
+        strides=(vertices.dtype.itemsize, field_dtype.itemsize),
+    )
+
+
+def read_ply_points(ply_file):
+    """(N, 3) points of a ply file. binary little-endian files are
+    memory-mapped (see read_ply_vertices), others are read by open3d
+
+    Args:
+        ply_file (str): ply file dir
+    """
+    try:
+        return ply_vertex_view(read_ply_vertices(ply_file))
+    except ValueError:
+        return np.asarray(o3d.io.read_point_cloud(ply_file).points)
+
+
+def ply_vertices_to_point_cloud(vertices):
+    """convert a structured vertex array into an o3d point cloud (copy)"""
+    names = vertices.dtype.names
+    cloud = o3d.geometry.PointCloud()
+    cloud.points = o3d.utility.Vector3dVector(
+        ply_vertex_view(vertices).astype(np.float64)
+    )
+    if "nx" in names:
+        cloud.normals = o3d.utility.Vector3dVector(
+            ply_vertex_view(vertices, ("nx", "ny", "nz")).astype(np.float64)
+        )
+    if "red" in names:
+        colors = ply_vertex_view(vertices, ("red", "green", "blue"))
+        if np.issubdtype(colors.dtype, np.integer):
+            colors = colors / np.iinfo(colors.dtype).max
+        cloud.colors = o3d.utility.Vector3dVector(colors.astype(np.float64))
+    return cloud
+
+
+def _segment_paths(pointcloud_base, pointcloud_prefix, num):
+    """paths of the files of a segment
+
+    Returns:
+        ply file, transform file, jsonl file
+    """
+    return (
+        osp.join(pointcloud_base, num, pointcloud_prefix + num + "_unaligned.ply"),
+        osp.join(pointcloud_base, num, "transform.npy"),
+        osp.join(pointcloud_base, num, pointcloud_prefix + num + ".jsonl"),
+    )
+
+
+def list_segments(pointcloud_base):
+    """sorted names of the segment folders under pointcloud_base"""
+    dirs = [
+        num
+        for num in os.listdir(pointcloud_base)
+        if osp.isdir(osp.join(pointcloud_base, num))
+    ]
+    # sort
+    dirs.sort()
+    return dirs
+
+
+def _load_segment(pointcloud_base, pointcloud_prefix, num):
+    """load a single segment, i.e. its point cloud (with transform.npy applied
+    if available), locations and timestamps
+
+    Args:
+        pointcloud_base: base dir
+        pointcloud_prefix: file name prefix
+        num: segment folder name
+
+    Returns:
+        cloud, positions, timestamps
+    """
+    ply_file, transform_file, jsonl_file = _segment_paths(
+        pointcloud_base, pointcloud_prefix, num
+    )
+
+    cloud = o3d.io.read_point_cloud(ply_file)
+
+    # if want to load transformation matrix
+    if osp.exists(transform_file):
+        transform = np.load(transform_file)
+        cloud.transform(transform)
+
+    positions, timestamps = load_trajectory(jsonl_file)
+
+    return cloud, positions, timestamps
+
+
+def _group_source_key(pointcloud_base, pointcloud_prefix, nums, cache_dir=""):
+    """content identity of a group of segments, i.e. digests of their ply and
+    transform files"""
+    source_key = []
+    for num in nums:
+        ply_file, transform_file, _ = _segment_paths(
+            pointcloud_base, pointcloud_prefix, num
+        )
+        source_key.append(cache.file_digest(ply_file, cache_dir))
+        source_key.append(cache.file_digest(transform_file, cache_dir))
+    return source_key
+
+
+def merged_group_keys(pointcloud_base, pointcloud_prefix, merge_cnt, cache_dir=""):
+    """content identity of each merged point cloud of load_point_clouds,
+    computed from the segment files without loading them
+
+    Args:
+        pointcloud_base: base dir
+        pointcloud_prefix: file name prefix
+        merge_cnt: merge count
+        cache_dir (str, optional): directory to remember file digests in.
+            Defaults to "".
+
+    Returns:
+        list[str]: cache key of each merged point cloud
+    """
+    dirs = list_segments(pointcloud_base)
+    return [
+        cache.cache_key(
+            _group_source_key(
+                pointcloud_base,
+                pointcloud_prefix,
+                dirs[cnt : cnt + merge_cnt],
+                cache_dir,
+            )
+        )
+        for cnt in range(0, len(dirs), merge_cnt)
+    ]
+
+
+def _allocate_point_cloud(n, has_colors, has_normals):
+    """allocate a point cloud of n points and return it together with writable
+    views of its points, colors and normals (None if not allocated).
+    np.empty is not touched before the copy into open3d, so only the open3d
+    buffers end up taking memory"""
+    cloud = o3d.geometry.PointCloud()
+    cloud.points = o3d.utility.Vector3dVector(np.empty((n, 3)))
+    if has_colors:
+        cloud.colors = o3d.utility.Vector3dVector(np.empty((n, 3)))
+    if has_normals:
+        cloud.normals = o3d.utility.Vector3dVector(np.empty((n, 3)))
+    return (
+        cloud,
+        np.asarray(cloud.points),
+        np.asarray(cloud.colors) if has_colors else None,
+        np.asarray(cloud.normals) if has_normals else None,
+    )
+
+
+def _load_merged_segments(
+    pointcloud_base,
+    pointcloud_prefix,
+    nums,
+    discard_first,
+    overlap_discard_num,
+    voxel_size,
+    cache_dir="",
+    cache_max_bytes=None,
+):
+    """load a group of continuous segments, merge and downsample them.
+    the merged cloud is allocated once with the size taken from the ply headers,
+    every segment is copied into its slice and released right after, so peak
+    memory is the merged cloud plus one segment
+
+    Args:
+        pointcloud_base: base dir
+        pointcloud_prefix: file name prefix
+        nums: segment folder names of the group
+        discard_first: whether to discard overlap frames of the first segment
+            of the group. only the very first segment of a session keeps them
+        overlap_discard_num: number of overlap frames to discard
+        voxel_size: voxel_size used for downsampling, 0.0 for no downsampling
+        cache_dir: downsampling cache directory, "" for no cache
+        cache_max_bytes: size budget of the downsampling cache
+
+    Returns:
+        cloud, cloud_down (None if not downsampled), positions (N, 3), timestamps (N,)
+    """
+    started = metrics.start()
+    cloud = None
+    positions = []
+    timestamps = []
+
+    if len(nums) > 1:
+        counts = []
+        has_colors = True
+        has_normals = True
+        for num in nums:
+            _, _, elements = _read_ply_header(
+                _segment_paths(pointcloud_base, pointcloud_prefix, num)[0]
+            )
+            count, properties = 0, []
+            for name, element_count, element_properties in elements:
+                if name == "vertex":
+                    count, properties = element_count, element_properties
+            properties = [prop_name for prop_name, _ in properties]
+            counts.append(count)
+            # same as o3d's +, attributes are kept only if all clouds have them
+            has_colors = has_colors and "red" in properties
+            has_normals = has_normals and "nx" in properties
+        cloud, points, colors, normals = _allocate_point_cloud(
+            sum(counts), has_colors, has_normals
+        )
+
+    start = 0
+    for i, num in enumerate(nums):
+        segment, segment_positions, segment_timestamps = _load_segment(
+            pointcloud_base, pointcloud_prefix, num
+        )
+
+        print("loaded point cloud " + num)
+
+        if i > 0 or discard_first:
+            segment_positions = segment_positions[overlap_discard_num:]
+            segment_timestamps = segment_timestamps[overlap_discard_num:]
+
+        positions.append(segment_positions)
+        timestamps.append(segment_timestamps)
+
+        if cloud is None:
+            # single segment, no merge needed
+            cloud = segment
+            continue
+
+        end = start + counts[i]
+        if len(segment.points) != counts[i]:
+            raise ValueError(
+                f"segment {num} has {len(segment.points)} points, "
+                f"but its ply header says {counts[i]}"
+            )
+        points[start:end] = np.asarray(segment.points)
+        if colors is not None:
+            colors[start:end] = np.asarray(segment.colors)
+        if normals is not None:
+            normals[start:end] = np.asarray(segment.normals)
+        start = end
+
+        # release the segment before loading the next one
+        del segment
+
+    positions = np.concatenate(positions, axis=0)
+    timestamps = np.concatenate(timestamps, axis=0)
+    metrics.record("load", started, segments=list(nums), points=len(cloud.points))
+
+    cloud_down = None
+    if voxel_size != 0.0:
+        # downsample
+        source_key = []
+        if cache_dir != "":
+            source_key = _group_source_key(
+                pointcloud_base, pointcloud_prefix, nums, cache_dir
+            )
+        cloud_down = cache.voxel_down_sample(
+            cloud, voxel_size, source_key, cache_dir, cache_max_bytes
+        )
+
+    return cloud, cloud_down, positions, timestamps
+
+
+def _group_trajectory(
+    pointcloud_base, pointcloud_prefix, nums, discard_first, overlap_discard_num
+):
+    """positions and timestamps of a group of continuous segments, same as
+    _load_merged_segments but without loading the point clouds"""
+    positions = []
+    timestamps = []
+    for i, num in enumerate(nums):
+        segment_positions, segment_timestamps = load_trajectory(
+            _segment_paths(pointcloud_base, pointcloud_prefix, num)[2]
+        )
+        if i > 0 or discard_first:
+            segment_positions = segment_positions[overlap_discard_num:]
+            segment_timestamps = segment_timestamps[overlap_discard_num:]
+        positions.append(segment_positions)
+        timestamps.append(segment_timestamps)
+    return np.concatenate(positions, axis=0), np.concatenate(timestamps, axis=0)
+
+
+def _append_skipped_group(
+    pointcloud_base,
+    pointcloud_prefix,
+    nums,
+    discard_first,
+    overlap_discard_num,
+    voxel_size,
+    outputs,
+):
+    """append a group not loaded by load_point_clouds, i.e. None clouds and its
+    trajectory, to (clouds, clouds_down, positions, timestamps)"""
+    clouds, clouds_down, position_arr, timestamp_arr = outputs
+    positions, timestamps = _group_trajectory(
+        pointcloud_base, pointcloud_prefix, nums, discard_first, overlap_discard_num
+    )
+    clouds.append(None)
+    if voxel_size != 0.0:
+        clouds_down.append(None)
+    position_arr.append(positions)
+    timestamp_arr.append(timestamps)
+
+
+def _load_merged_segments_worker(*args):
+    """process pool entry of _load_merged_segments.
+    o3d geometries are sent back as numpy arrays"""
+    cloud, cloud_down, positions, timestamps = _load_merged_segments(*args)
+    return (
+        cloud_to_arrays(cloud),
+        None if cloud_down is None else cloud_to_arrays(cloud_down),
+        positions,
+        timestamps,
+    )
 
 
 def load_point_clouds(
-    pointcloud_base, pointcloud_prefix, merge_cnt, overlap_discard_num, voxel_size=0.0
+    pointcloud_base,
+    pointcloud_prefix,
+    merge_cnt,
+    overlap_discard_num,
+    voxel_size=0.0,
+    num_workers=1,
+    cache_dir="",
+    cache_max_bytes=None,
+    groups=None,
 ):
     """load point clouds from a directory. the dir should look like
     pointcloud_base
@@ -27,93 +502,539 @@ def load_point_clouds(
             i.e. [0, 1200], [600, 1800] => [0, 1200], [1200, 1800]
             and the number should be 600
         voxel_size (float, optional): voxel_size used for downsampling. Defaults to 0.0.
+        num_workers (int, optional): number of worker processes. each merged group
+            is read, transformed, parsed and downsampled by one worker, results are
+            kept in folder order. Defaults to 1, i.e. load in the current process.
+        cache_dir (str, optional): cache directory of downsampled clouds, keyed on
+            the content of the segment files and voxel_size. Defaults to "", i.e.
+            no cache.
+        cache_max_bytes (int, optional): size budget of the cache. Defaults to None.
+        groups (list[int], optional): indices of the merged point clouds to load.
+            only the trajectories of the others are read, and their clouds are
+            None. Defaults to None, i.e. all.
 
     Returns: (clouds, clouds_down)
         clouds: list of point clouds
         clouds_down: list of downsampled point clouds
-        [locations]: list of list of locations
-        [timestamps]: list of list of timestamps
+        [locations]: list of (N, 3) arrays of locations
+        [timestamps]: list of (N,) int64 arrays of timestamps
     """
     clouds_down = []
     clouds = []
     position_arr = []
     timestamp_arr = []
 
-    initial = True
-
     # load point clouds
-    dirs = os.listdir(pointcloud_base)
-    # sort
-    dirs.sort()
-    for num in dirs:
-        cloud = o3d.io.read_point_cloud(
-            osp.join(
+    dirs = list_segments(pointcloud_base)
+
+    tasks = []
+    for cnt in range(0, len(dirs), merge_cnt):
+        if groups is not None and cnt // merge_cnt not in groups:
+            tasks.append(None)
+            continue
+        tasks.append(
+            (
                 pointcloud_base,
-                num,
-                pointcloud_prefix + num + "_unaligned.ply",
+                pointcloud_prefix,
+                dirs[cnt : cnt + merge_cnt],
+                cnt > 0,
+                overlap_discard_num,
+                voxel_size,
+                cache_dir,
+                cache_max_bytes,
             )
         )
 
-        # if want to load transformation matrix
-        if osp.exists(osp.join(pointcloud_base, num, "transform.npy")):
-            transform = np.load(osp.join(pointcloud_base, num, "transform.npy"))
-            cloud.transform(transform)
+    if num_workers > 1:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            futures = [
+                None
+                if task is None
+                else executor.submit(_load_merged_segments_worker, *task)
+                for task in tasks
+            ]
+            # collect in submission order to stay deterministic
+            for i, future in enumerate(futures):
+                if future is None:
+                    _append_skipped_group(
+                        pointcloud_base,
+                        pointcloud_prefix,
+                        dirs[i * merge_cnt : (i + 1) * merge_cnt],
+                        i > 0,
+                        overlap_discard_num,
+                        voxel_size,
+                        (clouds, clouds_down, position_arr, timestamp_arr),
+                    )
+                    continue
+                cloud, cloud_down, positions, timestamps = future.result()
+                print(f"merged point cloud starting {i * merge_cnt}")
+                clouds.append(cloud_from_arrays(*cloud))
+                if cloud_down is not None:
+                    clouds_down.append(cloud_from_arrays(*cloud_down))
+                position_arr.append(positions)
+                timestamp_arr.append(timestamps)
+    else:
+        for i, task in enumerate(tasks):
+            if task is None:
+                _append_skipped_group(
+                    pointcloud_base,
+                    pointcloud_prefix,
+                    dirs[i * merge_cnt : (i + 1) * merge_cnt],
+                    i > 0,
+                    overlap_discard_num,
+                    voxel_size,
+                    (clouds, clouds_down, position_arr, timestamp_arr),
+                )
+                continue
+            cloud, cloud_down, positions, timestamps = _load_merged_segments(*task)
+            print(f"merged point cloud starting {i * merge_cnt}")
+            clouds.append(cloud)
+            if cloud_down is not None:
+                clouds_down.append(cloud_down)
+            position_arr.append(positions)
+            timestamp_arr.append(timestamps)
 
-        clouds.append(cloud)
+    print(f"point clouds merge complete, {len(clouds)} generated")
+    print(f"positions merge complete, {len(position_arr)} generated")
+    print(f"timestamps merge complete, {len(timestamp_arr)} generated")
 
-        print("loaded point cloud " + num)
+    return clouds, clouds_down, position_arr, timestamp_arr
+
+
+def load_trajectories(
+    pointcloud_base, pointcloud_prefix, merge_cnt, overlap_discard_num
+):
+    """positions and timestamps of the merged point clouds of load_point_clouds,
+    without loading the point clouds
+
+    Args:
+        pointcloud_base: base dir
+        pointcloud_prefix: file name prefix
+        merge_cnt: merge count, see load_point_clouds
+        overlap_discard_num: number of overlap frames to discard
+
+    Returns: (locations, timestamps)
+        [locations]: list of (N, 3) arrays of locations
+        [timestamps]: list of (N,) int64 arrays of timestamps
+    """
+    dirs = list_segments(pointcloud_base)
+    trajectories = [
+        _group_trajectory(
+            pointcloud_base,
+            pointcloud_prefix,
+            dirs[cnt : cnt + merge_cnt],
+            cnt > 0,
+            overlap_discard_num,
+        )
+        for cnt in range(0, len(dirs), merge_cnt)
+    ]
+    return [t[0] for t in trajectories], [t[1] for t in trajectories]
+
+
+def write_point_cloud_stream(ply_file, clouds, has_colors=True, has_normals=True):
+    """write clouds one after another into a single binary little-endian ply,
+    without holding them in memory together. the vertex count is written as a
+    padded placeholder and patched once all clouds are written
+
+    Args:
+        ply_file (str): output ply file dir
+        clouds (iterable[o3d.geometry.PointCloud]): clouds, e.g. a generator
+        has_colors (bool, optional): write colors. Defaults to True.
+        has_normals (bool, optional): write normals. Defaults to True.
+
+    Returns:
+        int: number of vertices written
+    """
+    fields = [("x", "<f8"), ("y", "<f8"), ("z", "<f8")]
+    if has_normals:
+        fields += [("nx", "<f8"), ("ny", "<f8"), ("nz", "<f8")]
+    if has_colors:
+        fields += [("red", "u1"), ("green", "u1"), ("blue", "u1")]
+    dtype = np.dtype(fields)
+    ply_types = {"<f8": "double", "u1": "uchar"}
+
+    count_line = "element vertex "
+    header = [
+        "ply",
+        "format binary_little_endian 1.0",
+        "comment Created by DungeonAssistant",
+        count_line + " " * 20,
+    ]
+    header += [f"property {ply_types[t]} {name}" for name, t in fields]
+    header.append("end_header")
+    header = ("\n".join(header) + "\n").encode("ascii")
+
+    n = 0
+    with open(ply_file, "wb") as f:
+        f.write(header)
+        for cloud in clouds:
+            vertices = np.empty(len(cloud.points), dtype=dtype)
+            ply_vertex_view(vertices)[:] = np.asarray(cloud.points)
+            if has_normals:
+                ply_vertex_view(vertices, ("nx", "ny", "nz"))[:] = np.asarray(
+                    cloud.normals
+                )
+            if has_colors:
+                colors = np.clip(np.asarray(cloud.colors), 0.0, 1.0)
+                ply_vertex_view(vertices, ("red", "green", "blue"))[:] = np.round(
+                    colors * 255.0
+                )
+            f.write(vertices.tobytes())
+            n += len(vertices)
+
+        # patch vertex count
+        f.seek(header.index(count_line.encode("ascii")) + len(count_line))
+        f.write(f"{n:<20d}".encode("ascii"))
+
+    return n
+
+
+def merge_point_clouds_streaming(
+    pointcloud_base,
+    pointcloud_prefix,
+    merge_cnt,
+    overlap_discard_num,
+    matrices,
+    ply_file,
+):
+    """load, transform and merge the segments like load_point_clouds followed by
+    tfm.transform_clouds_and_trajectories, but append every segment to ply_file
+    right after it is transformed, so only one segment is in memory at a time
+
+    Args:
+        pointcloud_base: base dir, see load_point_clouds
+        pointcloud_prefix: file name prefix
+        merge_cnt: merge count, matrices[i] is applied to the i-th merged group
+        overlap_discard_num: number of overlap frames to discard
+        matrices (list[numpy.array]): transformation matrices of the merged groups
+        ply_file (str): output ply file dir
+
+    Returns: (locations, timestamps)
+        [locations]: list of (N, 3) arrays of transformed locations
+        [timestamps]: list of (N,) int64 arrays of timestamps
+    """
+    dirs = list_segments(pointcloud_base)
+
+    # same as o3d's +, attributes are kept only if all clouds have them
+    has_colors = True
+    has_normals = True
+    for num in dirs:
+        _, _, elements = _read_ply_header(
+            _segment_paths(pointcloud_base, pointcloud_prefix, num)[0]
+        )
+        properties = [
+            prop_name
+            for name, _, element_properties in elements
+            if name == "vertex"
+            for prop_name, _ in element_properties
+        ]
+        has_colors = has_colors and "red" in properties
+        has_normals = has_normals and "nx" in properties
+
+    position_arr = []
+    timestamp_arr = []
+
+    def transformed_segments():
+        for cnt in range(0, len(dirs), merge_cnt):
+            group = cnt // merge_cnt
+            positions = []
+            timestamps = []
+            for i, num in enumerate(dirs[cnt : cnt + merge_cnt]):
+                cloud, segment_positions, segment_timestamps = _load_segment(
+                    pointcloud_base, pointcloud_prefix, num
+                )
+                print("loaded point cloud " + num)
+
+                if i > 0 or cnt > 0:
+                    segment_positions = segment_positions[overlap_discard_num:]
+                    segment_timestamps = segment_timestamps[overlap_discard_num:]
+                positions.append(segment_positions)
+                timestamps.append(segment_timestamps)
+
+                if group < len(matrices):
+                    cloud.transform(matrices[group])
+                yield cloud
+
+            positions = np.concatenate(positions, axis=0)
+            if group < len(matrices):
+                tfm.apply_transformation(positions, matrices[group])
+            position_arr.append(positions)
+            timestamp_arr.append(np.concatenate(timestamps, axis=0))
+
+    n = write_point_cloud_stream(
+        ply_file, transformed_segments(), has_colors, has_normals
+    )
+    print(f"point clouds merge complete, {n} points written to {ply_file}")
+
+    return position_arr, timestamp_arr
+
+
+def _file_stamp(file):
+    """(mtime, size) of a file used for cache invalidation, None if missing"""
+    if not osp.exists(file):
+        return None
+    stat = os.stat(file)
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def _catalog_segment(pointcloud_base, pointcloud_prefix, num):
+    """compute the catalog entry of a segment, see load_segment_catalog"""
+    ply_file, transform_file, jsonl_file = _segment_paths(
+        pointcloud_base, pointcloud_prefix, num
+    )
+    points = read_ply_points(ply_file)
+    if osp.exists(transform_file):
+        transform = np.load(transform_file)
+        points = points @ transform[:3, :3].T + transform[:3, 3]
+    positions, timestamps = load_trajectory(jsonl_file)
 
-        positions, timestamps = load_coordinates_and_timestamps(
-            osp.join(pointcloud_base, num, pointcloud_prefix + num + ".jsonl")
+    entry = {}
+    entry["num"] = num
+    entry["ply_file"] = ply_file
+    entry["transform_file"] = transform_file if osp.exists(transform_file) else None
+    entry["jsonl_file"] = jsonl_file
+    entry["stamps"] = [_file_stamp(f) for f in (ply_file, transform_file, jsonl_file)]
+    entry["point_count"] = len(points)
+    if len(points) > 0:
+        entry["bbox_min"] = points.min(axis=0).tolist()
+        entry["bbox_max"] = points.max(axis=0).tolist()
+    else:
+        entry["bbox_min"] = None
+        entry["bbox_max"] = None
+    entry["frame_count"] = len(timestamps)
+    if len(timestamps) > 0:
+        entry["time_start"] = int(timestamps.min())
+        entry["time_end"] = int(timestamps.max())
+        entry["trajectory_min"] = positions.min(axis=0).tolist()
+        entry["trajectory_max"] = positions.max(axis=0).tolist()
+    else:
+        entry["time_start"] = None
+        entry["time_end"] = None
+        entry["trajectory_min"] = None
+        entry["trajectory_max"] = None
+    return entry
+
+
+def load_segment_catalog(pointcloud_base, pointcloud_prefix, catalog_file=None):
+    """load the catalog of the segments under pointcloud_base, so that the
+    number of segments and what they cover is known without loading them.
+    if catalog_file is given, the catalog is cached there, and an entry is
+    recomputed only if the mtime or size of one of its files changed. nothing
+    is written under pointcloud_base, which may be read-only
+
+    Args:
+        pointcloud_base: base dir, see load_point_clouds
+        pointcloud_prefix: file name prefix
+        catalog_file (str, optional): cache file, outside pointcloud_base.
+            Defaults to None, i.e. every segment is cataloged and nothing is
+            written.
+
+    Returns:
+        list of dict, sorted by folder name, each has
+            num: segment folder name
+            ply_file, transform_file (None if not available), jsonl_file: paths
+            stamps: (mtime, size) of the three files
+            point_count: number of points
+            bbox_min, bbox_max: bounding box of the transformed cloud
+            frame_count: number of trajectory frames
+            time_start, time_end: trajectory time range
+            trajectory_min, trajectory_max: bounding box of the trajectory
+    """
+    cached = {}
+    if catalog_file is not None and osp.exists(catalog_file):
+        with open(catalog_file, encoding="utf-8") as f:
+            catalog = json.load(f)
+        if catalog.get("pointcloud_prefix") == pointcloud_prefix:
+            cached = catalog["segments"]
+
+    segments = {}
+    changed = False
+    for num in list_segments(pointcloud_base):
+        entry = cached.get(num)
+        files = _segment_paths(pointcloud_base, pointcloud_prefix, num)
+        if entry is None or entry["stamps"] != [_file_stamp(f) for f in files]:
+            print("cataloging point cloud " + num)
+            entry = _catalog_segment(pointcloud_base, pointcloud_prefix, num)
+            changed = True
+        segments[num] = entry
+
+    if catalog_file is not None and (changed or len(segments) != len(cached)):
+        os.makedirs(osp.dirname(catalog_file) or ".", exist_ok=True)
+        catalog = {"pointcloud_prefix": pointcloud_prefix, "segments": segments}
+        with open(catalog_file + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(catalog, f, indent=2)
+        os.replace(catalog_file + ".tmp", catalog_file)
+
+    return [segments[num] for num in sorted(segments.keys())]
+
+
+def print_segment_catalog(catalog):
+    """print a short summary of a segment catalog"""
+    point_count = sum(entry["point_count"] for entry in catalog)
+    frame_count = sum(entry["frame_count"] for entry in catalog)
+    print(f"{len(catalog)} segments, {point_count} points, {frame_count} frames")
+    for entry in catalog:
+        print(
+            f"segment {entry['num']}: {entry['point_count']} points, "
+            f"{entry['frame_count']} frames, "
+            f"time [{entry['time_start']}, {entry['time_end']}]"
+        )
+
+
+TRAJECTORY_EXT = ".traj"
+_TRAJECTORY_MAGIC = b"DATRAJ01"
+_TRAJECTORY_HEADER_SIZE = 16
+
+_NUMBER = r"-?\d+(?:\.\d*)?(?:[eE][-+]?\d+)?"
+_TIMESTAMP_RE = re.compile(r'"timestamp"\s*:\s*(' + _NUMBER + ")")
+_LOCATION_RE = re.compile(r'"location"\s*:\s*\[([^\]]*)\]')
+# only capture the first 3 elements of the last column, i.e. transform[-4:-1]
+_TRANSFORM_RE = re.compile(
+    r'"transform"\s*:\s*\[(?:[^,\]]*,){12}([^,\]]*,[^,\]]*,[^,\]]*),[^,\]]*\]'
+)
+
+
+def _to_int64(timestamps):
+    """round float timestamps, keep integer ones exact"""
+    if np.issubdtype(timestamps.dtype, np.integer):
+        return timestamps.astype(np.int64)
+    return np.rint(timestamps).astype(np.int64)
+
+
+def _parse_numbers(values):
+    """parse a list of comma separated number strings into one flat array"""
+    return np.fromstring(",".join(values), dtype=np.float64, sep=",")
+
+
+def _load_binary_trajectory(traj_file):
+    """memory-map a binary trajectory file written by _save_binary_trajectory.
+    the mapping is copy-on-write, so the returned arrays can be modified
+    without touching the file
+
+    Args:
+        traj_file (str): .traj file dir
+
+    Returns:
+        points (np.array(N, 3)), timestamps (np.array(N,), int64)
+    """
+    with open(traj_file, "rb") as f:
+        header = f.read(_TRAJECTORY_HEADER_SIZE)
+    if len(header) != _TRAJECTORY_HEADER_SIZE or header[:8] != _TRAJECTORY_MAGIC:
+        raise ValueError(f"not a binary trajectory file: {traj_file}")
+    n = int(np.frombuffer(header, dtype="<u8", offset=8)[0])
+
+    if n == 0:
+        return np.zeros((0, 3)), np.zeros(0, dtype=np.int64)
+
+    timestamps = np.memmap(
+        traj_file, dtype="<i8", mode="c", offset=_TRAJECTORY_HEADER_SIZE, shape=(n,)
+    )
+    points = np.memmap(
+        traj_file,
+        dtype="<f8",
+        mode="c",
+        offset=_TRAJECTORY_HEADER_SIZE + n * 8,
+        shape=(n, 3),
+    )
+    return points, timestamps
+
+
+def _save_binary_trajectory(traj_file, points, timestamps):
+    """save coordinates and timestamps to a binary trajectory file. layout:
+    8 bytes magic, uint64 frame count N, N int64 timestamps, N x 3 float64 points,
+    all little-endian
+
+    Args:
+        traj_file (str): .traj file dir
+        points (np.array(N, 3)): points to be saved
+        timestamps (np.array(N,)): timestamps to be saved
+    """
+    points = np.ascontiguousarray(np.asarray(points, dtype="<f8").reshape(-1, 3))
+    timestamps = np.ascontiguousarray(_to_int64(np.asarray(timestamps)), dtype="<i8")
+    if len(points) != len(timestamps):
+        raise ValueError("points and timestamps should have the same length")
+
+    with open(traj_file, "wb") as f:
+        f.write(_TRAJECTORY_MAGIC)
+        f.write(np.array([len(points)], dtype="<u8").tobytes())
+        f.write(timestamps.tobytes())
+        f.write(points.tobytes())
+
+
+def load_trajectory(json_file):
+    """Given trajectory file get coordinates and timestamps as numpy arrays.
+    .traj files are memory-mapped (see _load_binary_trajectory). Other files
+    are read as jsonl, same as load_coordinates_and_timestamps, but the whole
+    file is parsed column-wise instead of line by line. Falls back to
+    load_coordinates_and_timestamps if the file has an unexpected layout.
+
+    Args:
+        json_file (str): json or .traj file dir
+
+    Returns:
+        points (np.array(N, 3)), timestamps (np.array(N,), int64)
+    """
+    if json_file.endswith(TRAJECTORY_EXT):
+        return _load_binary_trajectory(json_file)
+
+    with open(json_file, encoding="utf-8") as f:
+        text = f.read()
+
+    if not text.startswith("{"):
+        # empty file, or layout not written by us / multiscan
+        points, timestamps = load_coordinates_and_timestamps(json_file)
+        return (
+            np.asarray(points, dtype=np.float64).reshape(-1, 3),
+            _to_int64(np.asarray(timestamps)),
+        )
+
+    n_records = text.count("\n{") + 1
+    data = json.loads(text[: text.find("\n")] if "\n" in text else text)
+
+    timestamp_strs = _TIMESTAMP_RE.findall(text)
+    if "location" in data.keys():
+        # new way of storing location
+        coordinate_strs = _LOCATION_RE.findall(text)
+    else:
+        # legacy way of multiscan format
+        coordinate_strs = _TRANSFORM_RE.findall(text)
+    points = _parse_numbers(coordinate_strs)
+
+    if (
+        len(timestamp_strs) != n_records
+        or len(coordinate_strs) != n_records
+        or len(points) != n_records * 3
+    ):
+        # mixed or unusual format, parse line by line
+        points, timestamps = load_coordinates_and_timestamps(json_file)
+        return (
+            np.asarray(points, dtype=np.float64).reshape(-1, 3),
+            _to_int64(np.asarray(timestamps)),
         )
 
-        if initial:
-            initial = False
+    points = points.reshape(-1, 3)
+
+    # integer literals are parsed exactly, others go through float64
+    timestamps = ",".join(timestamp_strs)
+    if "." in timestamps or "e" in timestamps or "E" in timestamps:
+        timestamps = np.fromstring(timestamps, dtype=np.float64, sep=",")
+    else:
+        timestamps = np.fromstring(timestamps, dtype=np.int64, sep=",")
+
+    if "location" not in data.keys():
+        if "timestamp_unix" not in data.keys():
+            # legacy version of data, parse from filename
+            # YYYYMMDDTHHMMSS
+            timestamp_str = osp.basename(json_file)[:15]
+            datetime_obj = datetime.datetime.strptime(timestamp_str, "%Y%m%dT%H%M%S")
+            initial_unix_timestamp = int(datetime_obj.timestamp())
         else:
-            positions = positions[overlap_discard_num:]
-            timestamps = timestamps[overlap_discard_num:]
-
-        position_arr.append(positions)
-        timestamp_arr.append(timestamps)
-
-    merged_clouds = []
-    merged_positions = []
-    merged_timestamps = []
-
-    cnt = 0
-    while cnt < len(clouds):
-        print(f"merged point cloud starting {cnt}")
-
-        cloud = copy.deepcopy(clouds[cnt])
-        positions = copy.deepcopy(position_arr[cnt])
-        timestamps = copy.deepcopy(timestamp_arr[cnt])
-        for i in range(cnt + 1, min(cnt + merge_cnt, len(clouds))):
-            cloud = cloud + clouds[i]
-            positions.extend(position_arr[i])
-            timestamps.extend(timestamp_arr[i])
-        merged_clouds.append(cloud)
-        merged_positions.append(positions)
-        merged_timestamps.append(timestamps)
-        cnt += merge_cnt
-
-    print(f"point clouds merge complete, {len(merged_clouds)} generated")
-    print(f"positions merge complete, {len(merged_positions)} generated")
-    print(f"timestamps merge complete, {len(merged_timestamps)} generated")
-
-    clouds = merged_clouds
-    position_arr = merged_positions
-    timestamp_arr = merged_timestamps
-
-    if voxel_size == 0.0:
-        return clouds, clouds_down, position_arr, timestamp_arr
-
-    for cloud in clouds:
-        # downsample
-        cloud_down = cloud.voxel_down_sample(voxel_size=voxel_size)
+            initial_unix_timestamp = data["timestamp_unix"]
 
-        clouds_down.append(cloud_down)
+        # calculate the timestamp
+        timestamps = (timestamps - timestamps[0]) + initial_unix_timestamp * 1000000000
 
-    return clouds, clouds_down, position_arr, timestamp_arr
+    return points, _to_int64(timestamps)
 
 
 def load_coordinates_and_timestamps(json_file):
@@ -205,7 +1126,8 @@ def load_transformation_matrices(transformation_dir: str):
     if transformation_dir == "":
         return matrices
 
-    file_names = os.listdir(transformation_dir)
+    # other files, e.g. the saved pose graph, are not transformation matrices
+    file_names = [f for f in os.listdir(transformation_dir) if f.endswith(".npy")]
     # sort
     file_names.sort()
 
@@ -221,16 +1143,25 @@ def load_transformation_matrices(transformation_dir: str):
 
 
 def save_coodinates_and_timestamps(json_file, points, timestamps):
-    """save coordinates and timestamps to json file
+    """save coordinates and timestamps to json file.
+    if the file name ends with .traj, the binary trajectory format is used
 
     Args:
-        json_file (str): json file dir
-        points (list[np.array(3,)]): points to be saved
-        timestamps (list[float]): timestamps to be saved
+        json_file (str): json or .traj file dir
+        points (np.array(N, 3) | list[np.array(3,)]): points to be saved
+        timestamps (np.array(N,) | list[float]): timestamps to be saved
     """
+    if json_file.endswith(TRAJECTORY_EXT):
+        _save_binary_trajectory(json_file, points, timestamps)
+        return
+
+    # plain python types for json
+    points = np.asarray(points).tolist()
+    timestamps = np.asarray(timestamps).tolist()
+
     with open(json_file, "w", encoding="utf-8") as f:
         for i in range(len(points)):
             data = {}
             data["timestamp"] = timestamps[i]
-            data["location"] = points[i].tolist()
+            data["location"] = points[i]
             f.write(json.dumps(data) + "\n")
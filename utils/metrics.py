@@ -0,0 +1,97 @@
+import json
+import os
+import sys
+import time
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+import open3d as o3d
+
+
+_output_file = ""
+
+
+def set_output(output_file):
+    """set the JSON lines file stage records are appended to, "" for none.
+    every process appends to it directly, so records of pool workers end up
+    in the same file, tagged with their pid"""
+    global _output_file
+    _output_file = output_file
+
+
+def start():
+    """wall and CPU clocks at the start of a stage, see record
+
+    Returns:
+        (wall time, CPU time) in seconds
+    """
+    return time.perf_counter(), time.process_time()
+
+
+def peak_rss_mb():
+    """peak resident set size of the current process in MB, None if unknown"""
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on linux
+    if sys.platform == "darwin":
+        return max_rss / (1024 * 1024)
+    return max_rss / 1024
+
+
+def num_points(cloud):
+    """number of points of a legacy or tensor point cloud"""
+    if isinstance(cloud, o3d.t.geometry.PointCloud):
+        return len(cloud.point.positions)
+    return len(cloud.points)
+
+
+def result_fields(result):
+    """fitness, inlier RMSE and number of iterations (tensor results only) of a
+    registration result, as record fields"""
+    return {
+        "fitness": float(result.fitness),
+        "inlier_rmse": float(result.inlier_rmse),
+        "iterations": getattr(result, "num_iterations", None),
+    }
+
+
+def record(stage, started, **fields):
+    """write the JSON record of a stage to the output file, if one is set.
+    the record holds the stage name, the given fields, wall and CPU time since
+    started, peak RSS, pid and the time it was written
+
+    Args:
+        stage (str): stage name, e.g. "load", "fgr" or "icp"
+        started: clocks at the start of the stage, see start
+        fields: e.g. points, fitness, inlier RMSE, iterations
+
+    Returns:
+        dict: the record
+    """
+    wall, cpu = start()
+    entry = {
+        "stage": stage,
+        **fields,
+        "wall_time": wall - started[0],
+        "cpu_time": cpu - started[1],
+        "peak_rss_mb": peak_rss_mb(),
+        "pid": os.getpid(),
+        "time": time.time(),
+    }
+    if _output_file != "":
+        # a single write per record, appends of processes do not interleave
+        line = json.dumps(entry, default=_to_json) + "\n"
+        with open(_output_file, "a", encoding="utf-8") as f:
+            f.write(line)
+    return entry
+
+
+def _to_json(value):
+    """json.dumps fallback of numpy scalars and arrays"""
+    if hasattr(value, "tolist"):
+        return value.tolist()
+    return str(value)
@@ -1,37 +1,114 @@
 import numpy as np
-import copy
+
+
+def compose_transformations(*transformations):
+    """compose a chain of transformation matrices, the first one is applied first
+
+    Args:
+        transformations (numpy.array): 4x4 transformation matrices
+
+    Returns:
+        numpy.array: 4x4 transformation matrix
+    """
+    composed = np.identity(4)
+    for transformation in transformations:
+        composed = np.dot(transformation, composed)
+    return composed
+
+
+def apply_transformation(points, transformation, chunk_size=65536):
+    """inplace transformation of (N, 3) points, as rotation plus translation.
+    rows are processed in chunks, so no full size temporary array is allocated
+
+    Args:
+        points (numpy.array): (N, 3) float points, modified in place
+        transformation (numpy.array): 4x4 transformation matrix
+        chunk_size (int, optional): rows per chunk. Defaults to 65536.
+
+    Returns:
+        numpy.array: points
+    """
+    rotation_t = np.ascontiguousarray(transformation[:3, :3].T)
+    translation = transformation[:3, 3]
+    for start in range(0, len(points), chunk_size):
+        chunk = points[start : start + chunk_size]
+        chunk[:] = np.dot(chunk, rotation_t)
+        chunk += translation
+    return points
+
+
+def apply_transformations(points, offsets, transformations):
+    """inplace transformation of many trajectories concatenated in one array
+
+    Args:
+        points (numpy.array): (N, 3) float points, modified in place
+        offsets (list[int]): start of each trajectory, plus N at the end,
+            i.e. points[offsets[i]:offsets[i + 1]] is the i-th trajectory
+        transformations (list[numpy.array]): 4x4 transformation matrix of each
+            trajectory, or a list of chains to be composed first
+
+    Returns:
+        numpy.array: points
+    """
+    for i, transformation in enumerate(transformations):
+        if isinstance(transformation, (list, tuple)):
+            transformation = compose_transformations(*transformation)
+        apply_transformation(points[offsets[i] : offsets[i + 1]], transformation)
+    return points
 
 
 def transform_trajectory(points, transformation):
     """transform trajectory points with transformation matrix
 
     Args:
-        points (o3d.geometry.PointCloud): trajectory points
+        points (numpy.array): (N, 3) trajectory points, or list of points
         transformation (numpy.array): transformation matrix
 
     Returns:
         numpy.array: transformed trajectory points
     """
-    if len(points) == 0:
-        return points
     if points is None:
         return points
+    if len(points) == 0:
+        return points
 
-    # Convert the list of positions to a NumPy array
-    positions_array = np.array(points)
+    # copy, the input is not modified
+    positions_array = np.array(points, dtype=np.float64)
 
-    # Add a fourth column of ones to the positions array
-    positions_homogeneous = np.hstack(
-        (positions_array, np.ones((positions_array.shape[0], 1)))
-    )
+    return apply_transformation(positions_array, transformation)
+
+
+def rigid_transform(source, target):
+    """least squares rigid transformation from corresponding points (Kabsch).
+    with less than 3 points, or collinear points, only the translation of the
+    centroids is estimated
+
+    Args:
+        source (numpy.array): (N, 3) points
+        target (numpy.array): (N, 3) points, corresponding to source
 
-    # Apply the transformation matrix to the positions
-    transformed_positions_homogeneous = np.dot(positions_homogeneous, transformation.T)
+    Returns:
+        numpy.array: 4x4 transformation matrix T, target ~ T * source
+    """
+    source = np.asarray(source, dtype=np.float64)
+    target = np.asarray(target, dtype=np.float64)
+    source_center = source.mean(axis=0)
+    target_center = target.mean(axis=0)
 
-    # Remove the fourth column of ones from the transformed positions
-    transformed_positions = transformed_positions_homogeneous[:, :3]
+    rotation = np.identity(3)
+    if len(source) >= 3:
+        u, sigma, vt = np.linalg.svd(
+            np.dot((target - target_center).T, source - source_center)
+        )
+        # collinear points leave the rotation about their line undetermined
+        if sigma[1] > 1e-6 * max(sigma[0], 1e-12):
+            d = np.sign(np.linalg.det(np.dot(u, vt)))
+            rotation = np.dot(u * [1.0, 1.0, d], vt)
 
-    return transformed_positions
+    transformation = np.identity(4)
+    transformation[:3, :3] = rotation
+    transformation[:3, 3] = target_center - np.dot(rotation, source_center)
+    return transformation
 
 
 def transform_clouds_and_trajectories(clouds, trajectories, matrices):
@@ -39,33 +116,255 @@ def transform_clouds_and_trajectories(clouds, trajectories, matrices):
 
     Args:
         clouds (list[o3d.geometry.PointCloud]): clouds to be transformed
-        trajectories (list[list[numpy.array]]): list of list of points to be transformed
+        trajectories (list[numpy.array]): list of (N, 3) points to be transformed
         matrices (list[numpy.array]): list of transformation matrices
     """
     for i in range(min(len(matrices), len(clouds), len(trajectories))):
         clouds[i].transform(matrices[i])
-        trajectories[i] = transform_trajectory(trajectories[i], matrices[i])
+        if isinstance(trajectories[i], np.ndarray) and trajectories[i].dtype == float:
+            apply_transformation(trajectories[i], matrices[i])
+        else:
+            trajectories[i] = transform_trajectory(trajectories[i], matrices[i])
+
+
+def _cell_indices(points, scale):
+    """linear (row major) index of the x/z raster cell of every point
+
+    Returns:
+        cells (N,) int64, min_coords, max_coords, image_size
+    """
+    cell_x = np.round(points[:, 0] * scale).astype(np.int64)
+    cell_y = np.round(points[:, 2] * scale).astype(np.int64)
+    min_coords = np.array([cell_x.min(), cell_y.min()])
+    max_coords = np.array([cell_x.max(), cell_y.max()])
+    image_size = tuple(max_coords - min_coords + 1)
+
+    cells = cell_x
+    cells -= min_coords[0]
+    cells *= image_size[1]
+    cells += cell_y
+    cells -= min_coords[1]
+    return cells, min_coords, max_coords, image_size
+
+
+def _count_cells(cells, image_size, max_dense_cells):
+    """raster of the number of points in each cell, see density_raster"""
+    n_cells = int(np.prod(image_size))
+    if n_cells <= max_dense_cells:
+        occupied = None
+        counts = np.bincount(cells, minlength=n_cells)
+    else:
+        occupied, counts = np.unique(cells, return_counts=True)
 
+    dtype = np.uint8 if counts.max() <= np.iinfo(np.uint8).max else np.uint16
+    np.minimum(counts, np.iinfo(dtype).max, out=counts)
+    if occupied is None:
+        return counts.astype(dtype).reshape(image_size)
+    raster = np.zeros(image_size, dtype=dtype)
+    raster.ravel()[occupied] = counts
+    return raster
 
-def retrieve_floor_plan(cloud, scale=100):
-    """retrieve floor plan from point cloud
+
+def density_raster(points, scale=100, max_dense_cells=1 << 24, height_edges=None):
+    """number of points in each cell of a raster of the points projected on the
+    x/z plane, counted in one binning pass over linearized cell indices. rasters
+    up to max_dense_cells cells are counted with bincount, larger ones only
+    count their occupied cells, so memory stays linear in the points.
+    with height_edges, points are also binned by height (y) in the same pass,
+    into one raster per height band, all with the same corners
+
+    Args:
+        points: (N, 3) points
+        scale (int, optional): cells per unit. Defaults to 100.
+        max_dense_cells (int, optional): largest raster counted densely, with a
+            transient int64 per cell. Defaults to 1 << 24.
+        height_edges (list[float], optional): sorted edges of the height bands,
+            points below the first or above the last edge go to the outer bands.
+            Defaults to None, i.e. a single raster.
+
+    Returns:
+        raster: uint8 counts, or uint16 (saturated) if a cell has more than 255
+            points, indexed [x, z], or [band, x, z] with height_edges
+        min_coords, max_coords: cell coordinates of the raster corners
+    """
+    cells, min_coords, max_coords, image_size = _cell_indices(points, scale)
+    if height_edges is not None:
+        bands = np.searchsorted(height_edges[1:-1], points[:, 1], side="right")
+        bands *= int(np.prod(image_size))
+        cells += bands
+        del bands
+        image_size = (len(height_edges) - 1,) + image_size
+
+    return _count_cells(cells, image_size, max_dense_cells), min_coords, max_coords
+
+
+def remove_isolated_cells(raster, min_neighbors=1):
+    """clear, in place, the occupied cells of a raster with fewer than
+    min_neighbors occupied cells among their 8 neighbors
+
+    Args:
+        raster: 2d raster, 0 is empty
+        min_neighbors (int, optional): minimum occupied neighbors. Defaults to 1.
+
+    Returns:
+        raster
+    """
+    occupied = raster > 0
+    padded = np.pad(occupied, 1)
+    neighbors = np.zeros(raster.shape, dtype=np.uint8)
+    width, height = raster.shape
+    for dx in (0, 1, 2):
+        for dy in (0, 1, 2):
+            if dx != 1 or dy != 1:
+                neighbors += padded[dx : dx + width, dy : dy + height]
+    raster[occupied & (neighbors < min_neighbors)] = 0
+    return raster
+
+
+def floor_levels(counts, bin_edges, min_fraction=0.2, min_separation=2.0):
+    """heights of floors and ceilings, i.e. of the horizontal surfaces showing up
+    as peaks of the height histogram. peaks closer than min_separation, e.g.
+    both sides of a slab, are merged into the strongest one
 
     Args:
-        cloud: point cloud
+        counts: (B,) height histogram
+        bin_edges: (B + 1,) edges of the histogram bins
+        min_fraction (float, optional): minimum peak count, relative to the
+            highest bin. Defaults to 0.2.
+        min_separation (float, optional): minimum distance between levels.
+            Defaults to 2.0.
 
     Returns:
-        floor plan (image), min_coords, max_coords
+        list[int]: bins of the levels, sorted
     """
-    cloud_xy = copy.deepcopy(np.asarray(cloud.points))[:, (0, 2)]
-    # turn them into 2d floor plan image
-    cloud_xy = np.round(cloud_xy * scale).astype(np.int32)
+    centers = (bin_edges[:-1] + bin_edges[1:]) / 2
+    padded = np.pad(counts, 1)
+    peaks = np.flatnonzero(
+        (counts >= padded[:-2])
+        & (counts > padded[2:])
+        & (counts >= min_fraction * counts.max())
+    )
+    levels = []
+    for peak in peaks[np.argsort(-counts[peaks], kind="stable")]:
+        distances = [abs(centers[peak] - centers[level]) for level in levels]
+        if all(distance >= min_separation for distance in distances):
+            levels.append(int(peak))
+    return sorted(levels)
 
-    min_coords = np.min(cloud_xy, axis=0)
-    max_coords = np.max(cloud_xy, axis=0)
-    image_size = np.abs(max_coords - min_coords) + 1
-    cloud_xy -= min_coords
 
-    floor_plan = np.zeros(image_size)
-    floor_plan[cloud_xy[:, 0], cloud_xy[:, 1]] = 1
+def floor_density_raster(
+    points,
+    scale=100,
+    max_dense_cells=1 << 24,
+    bin_size=0.05,
+    min_separation=2.0,
+    **kwargs,
+):
+    """density_raster with one height band per floor, detected in the same pass.
+    every point gets its cell index and height bin once, the height histogram
+    is a bincount of the height bins and the bands are assigned per bin, so the
+    points are not read again. bands are cut at the lower edge of the bin below
+    each detected level (see floor_levels), so that the surface of a level
+    starts the band above it, except levels within min_separation of the lowest
+    or highest point, i.e. the bottom floor and the top ceiling
 
+    Args:
+        points: (N, 3) points
+        scale (int, optional): see density_raster. Defaults to 100.
+        max_dense_cells (int, optional): see density_raster. Defaults to 1 << 24.
+        bin_size (float, optional): height histogram bin size. Defaults to 0.05.
+        min_separation (float, optional): see floor_levels. Defaults to 2.0.
+        kwargs: see floor_levels
+
+    Returns:
+        raster: [band, x, z] counts, see density_raster
+        min_coords, max_coords: cell coordinates of the raster corners
+        height_edges: sorted band edges, from the lowest to the highest bin edge
+    """
+    cells, min_coords, max_coords, image_size = _cell_indices(points, scale)
+    height_bins = np.floor(points[:, 1] / bin_size).astype(np.int64)
+    low_bin = height_bins.min()
+    height_bins -= low_bin
+    counts = np.bincount(height_bins)
+    bin_edges = (low_bin + np.arange(len(counts) + 1)) * bin_size
+
+    low, high = bin_edges[0], bin_edges[-1]
+    cut_bins = [
+        level - 1
+        for level in floor_levels(
+            counts, bin_edges, min_separation=min_separation, **kwargs
+        )
+        if level > 0
+        and bin_edges[level] - low >= min_separation
+        and high - bin_edges[level + 1] >= min_separation
+    ]
+    height_edges = [float(low)] + [float(bin_edges[b]) for b in cut_bins]
+    height_edges.append(float(high))
+
+    bin_bands = np.searchsorted(cut_bins, np.arange(len(counts)), side="right")
+    bands = bin_bands[height_bins]
+    del height_bins
+    bands *= int(np.prod(image_size))
+    cells += bands
+    del bands
+    image_size = (len(height_edges) - 1,) + image_size
+
+    raster = _count_cells(cells, image_size, max_dense_cells)
+    return raster, min_coords, max_coords, height_edges
+
+
+def clean_floor_plan(floor_plan, min_count=1, min_neighbors=0, density=False):
+    """threshold and denoise a density raster into a floor plan
+
+    Args:
+        floor_plan: density raster, [x, z] or [band, x, z], see density_raster
+        min_count (int, optional): minimum number of points of an occupied
+            pixel. Defaults to 1.
+        min_neighbors (int, optional): occupied pixels with fewer occupied
+            neighbors are removed as noise, see remove_isolated_cells.
+            Defaults to 0, i.e. none.
+        density (bool, optional): return the point density of occupied pixels
+            instead of 0/1. Defaults to False.
+
+    Returns:
+        floor plan (uint8 image, or uint16 density)
+    """
+    if min_count > 1:
+        floor_plan[floor_plan < min_count] = 0
+    if min_neighbors > 0:
+        for band in floor_plan.reshape((-1,) + floor_plan.shape[-2:]):
+            remove_isolated_cells(band, min_neighbors)
+    if not density:
+        floor_plan = (floor_plan > 0).view(np.uint8)
+    return floor_plan
+
+
+def retrieve_floor_plan(
+    cloud,
+    scale=100,
+    min_count=1,
+    min_neighbors=0,
+    density=False,
+    height_edges=None,
+):
+    """retrieve floor plan from point cloud, see density_raster and
+    clean_floor_plan
+
+    Args:
+        cloud: point cloud, or (N, 3) points (e.g. io.read_ply_points)
+        scale (int, optional): pixels per unit. Defaults to 100.
+        min_count, min_neighbors, density: see clean_floor_plan
+        height_edges (list[float], optional): edges of height bands, each band
+            gets its own floor plan. Defaults to None, i.e. all points in one
+            floor plan. see floor_density_raster to detect them.
+
+    Returns:
+        floor plan (uint8 image, or uint16 density), stacked [band, x, z] with
+        height_edges, min_coords, max_coords
+    """
+    points = np.asarray(cloud.points) if hasattr(cloud, "points") else cloud
+    floor_plan, min_coords, max_coords = density_raster(
+        points, scale, height_edges=height_edges
+    )
+    floor_plan = clean_floor_plan(floor_plan, min_count, min_neighbors, density)
     return floor_plan, min_coords, max_coords
@@ -0,0 +1,116 @@
+import json
+import os
+import os.path as osp
+import numpy as np
+import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
+
+
+TILE_PATH = "{zoom}/{row}/{col}.png"
+
+
+def downsample_max(image):
+    """halve an image by taking the max of each 2x2 block, so that occupied
+    pixels stay visible at coarser zooms. odd sizes are padded with zeros"""
+    rows, cols = image.shape
+    padded = np.pad(image, ((0, rows % 2), (0, cols % 2)))
+    return padded.reshape(padded.shape[0] // 2, 2, padded.shape[1] // 2, 2).max(
+        axis=(1, 3)
+    )
+
+
+def _write_tile_row(tiles_dir, zoom, row, band, tile_size, vmax):
+    """write the non-empty tiles of a band of tile_size image rows, each padded
+    to tile_size x tile_size
+
+    Returns:
+        list[int]: columns of the written tiles
+    """
+    cols = []
+    for col in range(0, band.shape[1], tile_size):
+        tile = band[:, col : col + tile_size]
+        if not tile.any():
+            continue
+        if tile.shape != (tile_size, tile_size):
+            tile = np.pad(
+                tile,
+                ((0, tile_size - tile.shape[0]), (0, tile_size - tile.shape[1])),
+            )
+        tile_file = osp.join(
+            tiles_dir, TILE_PATH.format(zoom=zoom, row=row, col=col // tile_size)
+        )
+        os.makedirs(osp.dirname(tile_file), exist_ok=True)
+        plt.imsave(tile_file, tile, cmap="gray", vmin=0, vmax=vmax)
+        cols.append(col // tile_size)
+    return cols
+
+
+def write_floor_plan_tiles(
+    tiles_dir,
+    floor_plan,
+    min_coords,
+    max_coords,
+    scale,
+    tile_size=256,
+    num_workers=1,
+):
+    """write a floor plan as a zoom pyramid of tile_size x tile_size PNG tiles
+    in tiles_dir/{zoom}/{row}/{col}.png, with metadata.json. the last zoom is
+    the full resolution and every coarser zoom halves it (see downsample_max),
+    down to zoom 0 where the floor plan fits in one tile. rows and columns
+    follow the image written by floorplan_extraction.py, and only non-empty
+    tiles are written, in num_workers processes
+
+    Args:
+        tiles_dir (str): output directory
+        floor_plan: 2d floor plan image, see tfm.retrieve_floor_plan
+        min_coords, max_coords: floor plan corners, see tfm.retrieve_floor_plan
+        scale (int): scale of the floor plan
+        tile_size (int, optional): tile size in pixels. Defaults to 256.
+        num_workers (int, optional): number of processes. Defaults to 1.
+
+    Returns:
+        dict: metadata, i.e. corners, scale, tile size, max zoom, and image
+            size and tiles ([row, col]) of every zoom
+    """
+    os.makedirs(tiles_dir, exist_ok=True)
+    max_zoom = max(0, int(np.ceil(np.log2(max(floor_plan.shape) / tile_size))))
+    vmax = max(1, int(floor_plan.max()))
+
+    levels = [floor_plan]
+    for _ in range(max_zoom):
+        levels.append(downsample_max(levels[-1]))
+    levels.reverse()
+
+    tasks = []
+    for zoom, image in enumerate(levels):
+        for row in range(0, image.shape[0], tile_size):
+            band = image[row : row + tile_size]
+            if band.any():
+                tasks.append((tiles_dir, zoom, row // tile_size, band, tile_size, vmax))
+
+    if num_workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(max_workers=num_workers) as executor:
+            written = list(executor.map(_write_tile_row, *zip(*tasks)))
+    else:
+        written = [_write_tile_row(*task) for task in tasks]
+
+    zooms = {
+        zoom: {"image_size": list(image.shape), "tiles": []}
+        for zoom, image in enumerate(levels)
+    }
+    for (_, zoom, row, _, _, _), cols in zip(tasks, written):
+        zooms[zoom]["tiles"].extend([row, col] for col in cols)
+
+    metadata = {
+        "min_coords": [int(c) for c in min_coords],
+        "max_coords": [int(c) for c in max_coords],
+        "scale": scale,
+        "tile_size": tile_size,
+        "max_zoom": max_zoom,
+        "tile_path": TILE_PATH,
+        "zooms": zooms,
+    }
+    with open(osp.join(tiles_dir, "metadata.json"), "w", encoding="utf-8") as f:
+        json.dump(metadata, f, indent=2)
+    return metadata